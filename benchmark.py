@@ -0,0 +1,86 @@
+""" Mini SQL Engine Benchmarks """
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import engine
+
+"""
+    USAGE
+    -----
+    python benchmark.py [rows]
+    Generates synthetic tables of rows records (1000000 by default)
+    and reports the throughput of the csv tokenizer
+"""
+
+def generate_csv(file_name, rows, quoted):
+    """
+        Write a synthetic table with 3 integer columns and 1 string column
+        If quoted is True the string column is double quoted and contains commas
+    """
+    random.seed(rows)
+    with open(file_name, "w") as f:
+        for i in xrange(rows):
+            if quoted:
+                name = '"name %d, %d"' % (i % 1000, i % 7)
+            else:
+                name = "name%d" % (i % 1000)
+            f.write("%d,%d,%d,%s\n" % (i, random.randint(0, 100000), i % 13, name))
+
+def split_parser(records_data, number_of_columns):
+    """
+        The per field parser the engine used before the tokenizer
+        Breaks quoted fields that contain commas
+    """
+    columns = [[] for _ in xrange(number_of_columns)]
+    for record_data in records_data:
+        record = record_data.split(",")
+        for i, column in enumerate(columns):
+            col = record[i].strip()
+            if col[0] == '"':
+                col = col.split('"')[1]
+            elif col[0] == "'":
+                col = col.split("'")[1]
+            column.append(col)
+    return columns
+
+def measure(name, function, records_data, size):
+    """
+        Run function over records_data and print rows/s and MB/s
+    """
+    start_time = time.time()
+    function(records_data, 4)
+    elapsed = max(time.time() - start_time, 1e-6)
+    print "%-28s %8.3f s %12d rows/s %8.1f MB/s" % (name, elapsed, \
+        len(records_data) / elapsed, size / 1048576.0 / elapsed)
+
+def benchmark_tokenizer(rows):
+    """
+        Compare the split parser, the tokenizer and the tokenizer with typed columns
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        for quoted in (False, True):
+            file_name = os.path.join(directory, "table.csv")
+            generate_csv(file_name, rows, quoted)
+            size = os.path.getsize(file_name)
+            with open(file_name, "r") as f:
+                records_data = f.read().splitlines(True)
+
+            print "%d rows, %.1f MB, %s string column" % (rows, size / 1048576.0, \
+                "quoted" if quoted else "plain")
+            if not quoted:
+                measure("split parser", split_parser, records_data, size)
+            measure("tokenizer", engine.parse_records, records_data, size)
+            measure("tokenizer + typed columns", lambda records_data, number_of_columns: \
+                [engine.make_column(column) for column in \
+                engine.parse_records(records_data, number_of_columns)], records_data, size)
+            print ""
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    benchmark_tokenizer(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -3,7 +3,27 @@
 import sys
 import errno
 import os
-import copy
+import re
+import csv
+import gc
+from contextlib import contextmanager
+import mmap
+import shutil
+import struct
+import time
+import marshal
+import hashlib
+import heapq
+import tempfile
+import multiprocessing
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip, chain, islice, combinations
+from operator import itemgetter, eq, gt, ge, lt, le
+try:
+    import numpy
+except ImportError:
+    numpy = None
 import sqlparse
 from sqlparse.tokens import Keyword, Wildcard
 
@@ -29,7 +49,117 @@ from sqlparse.tokens import Keyword, Wildcard
     For all other types of joins, all the columns that are asked to be projected are projected.
 """
 
-# List of Table Names
+# ----------SETTINGS------------------------
+def env_setting(name, default):
+    """
+        Returns the integer value of the environment variable MINI_SQL_<name>
+        Returns default if it is not set
+    """
+    try:
+        return int(os.environ["MINI_SQL_" + name])
+    except (KeyError, ValueError):
+        return default
+
+# Print statistics about loading and execution to stderr
+DEBUG = env_setting("DEBUG", 0)
+
+def debug(message):
+    """
+        Print message to stderr if DEBUG is set
+    """
+    if DEBUG:
+        sys.stderr.write(message + "\n")
+
+# Files bigger than PARALLEL_LOAD_THRESHOLD bytes are split into byte ranges
+# which are parsed by LOAD_PROCESSES worker processes
+PARALLEL_LOAD_THRESHOLD = env_setting("PARALLEL_LOAD_THRESHOLD", 32 * 1024 * 1024)
+LOAD_PROCESSES = env_setting("LOAD_PROCESSES", multiprocessing.cpu_count())
+LOAD_CHUNKS_PER_PROCESS = 4
+
+# Scans produce batches of SCAN_BATCH_SIZE records
+# Tables bigger than STREAM_THRESHOLD bytes without binary column files are
+# read batch by batch from the csv instead of being loaded into COLUMN_STORE
+SCAN_BATCH_SIZE = env_setting("SCAN_BATCH_SIZE", 1024)
+STREAM_THRESHOLD = env_setting("STREAM_THRESHOLD", 256 * 1024 * 1024)
+
+# Columns of at least ENCODING_MIN_ROWS values are encoded at load time
+#   run length -- if the average run of equal values is RUN_LENGTH_MIN_RUN long
+#   dictionary -- if there are at most DICTIONARY_MAX_VALUES distinct values
+#                 and each of them occurs DICTIONARY_MIN_REPEAT times on average
+ENCODING_MIN_ROWS = env_setting("ENCODING_MIN_ROWS", 1024)
+RUN_LENGTH_MIN_RUN = 8
+DICTIONARY_MAX_VALUES = 65536
+DICTIONARY_MIN_REPEAT = 4
+
+# With NumPy installed and VECTORIZED set, WHERE conditions of single table queries
+# on integer columns are evaluated as boolean masks over whole columns and
+# aggregates of integer columns as array reductions
+VECTORIZED = env_setting("VECTORIZED", 1)
+
+# The children of AND/OR conditions are evaluated in the order of their cost and of
+# their pass rate on the first PREDICATE_SAMPLE_SIZE records of every batch (0 keeps
+# the written order), so that most records are decided by the first cheap conditions
+PREDICATE_SAMPLE_SIZE = env_setting("PREDICATE_SAMPLE_SIZE", 32)
+
+# OR-chains of at least OR_CHAIN_MIN_LENGTH equalities of a column with constants
+# are rewritten into one IN condition, a hashed set lookup (0 never rewrites them)
+OR_CHAIN_MIN_LENGTH = env_setting("OR_CHAIN_MIN_LENGTH", 3)
+
+# Parsed tables whose binary column files can't be written are cached in SNAPSHOT_DIR
+# across runs instead, the least recently used snapshots are evicted when the directory grows over SNAPSHOT_CACHE_BYTES
+SNAPSHOT_DIR = ".snapshots"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_CACHE_BYTES = env_setting("SNAPSHOT_CACHE_BYTES", 512 * 1024 * 1024)
+
+# SELECT queries are compiled into plans which are cached in QUERY_PLAN_FILE by the
+# text of the query with its integer constants, matched by QUERY_CONSTANT outside of
+# quoted strings, replaced by ?, the QUERY_PLAN_CACHE_SIZE most recently compiled
+# ones are kept
+QUERY_PLAN_CACHE_SIZE = env_setting("QUERY_PLAN_CACHE_SIZE", 256)
+QUERY_CONSTANT = re.compile(r"""('[^']*'|"[^"]*")|(?<![\w.])([+-]?\d+)(?![\w.])""")
+
+# Zone maps keep the min and max of every block of ZONE_MAP_BLOCK_SIZE records
+# of every integer column, scans with a WHERE clause skip the blocks that can't match
+ZONE_MAP_BLOCK_SIZE = env_setting("ZONE_MAP_BLOCK_SIZE", 1024)
+
+# Joins of up to JOIN_DP_MAX_TABLES tables are ordered by dynamic programming over
+# all subsets of the tables, bigger joins are ordered greedily
+# A range join condition is estimated to keep RANGE_JOIN_SELECTIVITY of the combinations
+JOIN_DP_MAX_TABLES = env_setting("JOIN_DP_MAX_TABLES", 10)
+RANGE_JOIN_SELECTIVITY = 1.0 / 3
+
+# Hash joins whose hash table is estimated to take more than HASH_JOIN_MEMORY bytes
+# write both inputs to at most GRACE_MAX_PARTITIONS temporary files, partitioned
+# on the join key, and join them partition by partition
+HASH_JOIN_MEMORY = env_setting("HASH_JOIN_MEMORY", 256 * 1024 * 1024)
+GRACE_MAX_PARTITIONS = 256
+HASH_ENTRY_BYTES = 100
+
+# Hash joins of at least PARALLEL_JOIN_THRESHOLD records of the next table partition
+# both inputs on the join key into JOIN_PARTITIONS partitions, which are joined by
+# JOIN_PROCESSES worker processes (0 disables it)
+# Only the joins of the partitions run in parallel, this process still scans, spills
+# and merges every record, so it rarely beats the serial hash join and is off by default
+# With JOIN_ORDERED the joined records keep the order of the cross product, otherwise
+# the records of every partition are returned as soon as it is joined
+PARALLEL_JOIN_THRESHOLD = env_setting("PARALLEL_JOIN_THRESHOLD", 0)
+JOIN_PROCESSES = env_setting("JOIN_PROCESSES", multiprocessing.cpu_count())
+JOIN_PARTITIONS = env_setting("JOIN_PARTITIONS", 4 * JOIN_PROCESSES)
+JOIN_ORDERED = env_setting("JOIN_ORDERED", 1)
+
+# The biggest table of a join is scanned through the sets of keys of the smaller
+# tables held in memory it is equi-joined with, records that can't have a match are
+# dropped before the join (0 disables it)
+SEMI_JOIN_FILTERS = env_setting("SEMI_JOIN_FILTERS", 1)
+
+# Instead of reading its biggest table, a join probes the index of the join column
+# of that table with every record of the other tables, when they are estimated to
+# produce at most INDEX_JOIN_MAX_OUTER records and INDEX_JOIN_RATIO times fewer
+# records than the biggest table has
+INDEX_JOIN_MAX_OUTER = env_setting("INDEX_JOIN_MAX_OUTER", 1024)
+INDEX_JOIN_RATIO = 16
+
+# List of Table Names (tables looked up in the catalog so far)
 TABLE_NAMES_LIST = []
 
 # List of Lists of Columns of Tables
@@ -38,13 +168,68 @@ COLUMNS_LIST = []
 # Columns Dict(key == table_name and value == list_of_columns_of_table_with_name_table_name)
 COLUMNS_DICT = {}
 
-# Records Dict(key == table_name and value == list_of_records_of_table_with_name_table_name)
-RECORDS_DICT = {}
+# Catalog
+# catalog/tables/table_name -- columns of table_name, one per line
+# catalog/VERSION           -- catalog version and the mtime, size of metadata.txt
+#                              at the time it was last imported or exported
+# catalog/query_plans       -- the cached plans of SELECT queries along with the
+#                              columns of the tables they were made for, their
+#                              constants are placeholders bound when they are run
+# Every file is written next to its final place and renamed over it
+CATALOG_DIR = "catalog"
+CATALOG_TABLES_DIR = os.path.join(CATALOG_DIR, "tables")
+CATALOG_VERSION_FILE = os.path.join(CATALOG_DIR, "VERSION")
+QUERY_PLAN_FILE = os.path.join(CATALOG_DIR, "query_plans")
+
+# Column Store(key == table_name and value == list_of_columns_of_table_with_name_table_name)
+# Every column is filled once at load time and is either
+#   array('l')   -- integer column
+#   list         -- string column (kept exactly as it appears in the csv)
+#   MappedColumn -- column read straight from the binary column file
+#   DictionaryColumn, RunLengthColumn -- encoded low cardinality columns
+# Integer columns have typecode == "l"
+COLUMN_STORE = {}
+
+# Binary column files
+# table_name.bin/col.col holds one column of table_name as
+#   header -- magic, version, kind, width of a value, number of values
+#   values -- depend on the kind
+#       "i" -- little endian 8 byte ints
+#       "s" -- NUL padded strings
+#       "d" -- dictionary codes of width bytes, the dictionary is in col.dict
+#       "r" -- ends of the runs as 8 byte ints, the value of each run is in col.runs
+# table_name.bin/schema holds the column names of table_name, one per line and in
+# order, the directory is only used while it matches the metadata of table_name
+BINARY_SUFFIX = ".bin"
+BINARY_MAGIC = "MSQC"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sBcHQ")
+BINARY_CHUNK = 4096
+
+# Zone Maps(key == table_name and value == list_of_zone_maps_of_columns_of_table)
+# The zone map of a column is a list of (min, max) of every block or None
+# table_name.bin/col.zmap persists it as
+#   header -- magic, version, block size, number of blocks
+#   values -- min and max of every block as little endian 8 byte ints
+ZONE_MAPS = {}
+ZONE_MAP_MAGIC = "MSQZ"
+ZONE_MAP_VERSION = 1
+ZONE_MAP_HEADER = struct.Struct("<4sBIQ")
+
+# Column Indexes(key == table_name and value == {column index: column index})
+# The index of a column maps every value to the ascending positions holding it
+# table_name.bin/col.idx persists it as the marshalled (magic, version, index)
+COLUMN_INDEXES = {}
+COLUMN_INDEX_MAGIC = "MSQI"
+COLUMN_INDEX_VERSION = 1
+
+# Statistics of all the scans run by this process
+SCAN_STATS = {"blocks_scanned": 0, "blocks_skipped": 0}
 
 
 
 # ----------PARSE STATIC DATA---------------
-def parse_metadata():
+def parse_metadata(file_name="metadata.txt"):
     """
         Parse the metadata about tables
         1. Fill TABLE_NAMES_LIST
@@ -52,7 +237,7 @@ def parse_metadata():
         3. FILL_COLUMNS_DICT
     """
 
-    with open("metadata.txt", "r") as f:
+    with open(file_name, "r") as f:
         tables_data = f.read().split("<begin_table>\n")
 
         # first entry of tables_data is empty
@@ -68,7 +253,6 @@ def parse_metadata():
                 <end_table>
             """
             table_name = table_data.split("\n")[0].strip()
-            TABLE_NAMES_LIST.append(table_name)
             columns = []
             cols = table_data.splitlines()
 
@@ -80,67 +264,1534 @@ def parse_metadata():
 
             for col in cols:
                 columns.append(col.strip())
-            COLUMNS_LIST.append(columns)
-            COLUMNS_DICT[table_name] = columns
+            add_table_columns(table_name, columns)
+
+def add_table_columns(table_name, columns):
+    """
+        Add table_name with columns to TABLE_NAMES_LIST, COLUMNS_LIST and COLUMNS_DICT
+    """
+    if table_name in COLUMNS_DICT:
+        COLUMNS_LIST[TABLE_NAMES_LIST.index(table_name)] = columns
+    else:
+        TABLE_NAMES_LIST.append(table_name)
+        COLUMNS_LIST.append(columns)
+    COLUMNS_DICT[table_name] = columns
+
+def remove_table_columns(table_name):
+    """
+        Remove table_name from TABLE_NAMES_LIST, COLUMNS_LIST and COLUMNS_DICT
+    """
+    if table_name in COLUMNS_DICT:
+        del COLUMNS_LIST[TABLE_NAMES_LIST.index(table_name)]
+        TABLE_NAMES_LIST.remove(table_name)
+        del COLUMNS_DICT[table_name]
+
+# ----------CATALOG-------------------------
+# Mode of new files written through temporary files, the one open would give them
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+@contextmanager
+def atomically_written_file(file_name):
+    """
+        Yields a temporary file of its own next to file_name, which is renamed over
+        file_name at the end of the block so that readers see either the old or the
+        new file and concurrent writers don't collide, the last rename wins
+        An existing file_name keeps its mode
+        The temporary file is removed if the block raises
+    """
+    try:
+        mode = os.stat(file_name).st_mode & 0o777
+    except OSError:
+        mode = FILE_MODE
+    descriptor, temp_file_name = tempfile.mkstemp(suffix=".tmp", \
+        prefix=os.path.basename(file_name) + ".", dir=os.path.dirname(file_name) or os.curdir)
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            yield f
+        os.chmod(temp_file_name, mode)
+        os.rename(temp_file_name, file_name)
+    except:
+        try:
+            os.remove(temp_file_name)
+        except OSError:
+            pass
+        raise
+
+def write_file_atomically(file_name, data):
+    """
+        Write data to file_name so that readers see either the old or the new file
+    """
+    with atomically_written_file(file_name) as f:
+        f.write(data)
 
-def parse_data():
+def catalog_table_file(table_name):
     """
-        Parse the data present in the tables
-        1. Fill RECORDS_DICT
+        Returns the path of the catalog entry of table_name
     """
+    return os.path.join(CATALOG_TABLES_DIR, table_name)
+
+def metadata_stamp():
+    """
+        Returns "mtime size" of metadata.txt or "" if it doesn't exist
+    """
+    try:
+        stat = os.stat("metadata.txt")
+    except OSError:
+        return ""
+    return "%r %d" % (stat.st_mtime, stat.st_size)
+
+def read_catalog_version():
+    """
+        Returns the catalog version and the recorded metadata.txt stamp
+        Returns 0, None if there is no catalog
+    """
+    try:
+        with open(CATALOG_VERSION_FILE, "r") as f:
+            lines = f.read().split("\n")
+        return int(lines[0]), lines[1]
+    except (IOError, ValueError, IndexError):
+        return 0, None
+
+def write_catalog_version(version):
+    """
+        Record a new catalog version along with the current metadata.txt stamp
+    """
+    write_file_atomically(CATALOG_VERSION_FILE, "%d\n%s\n" % (version, metadata_stamp()))
+
+def catalog_table_names():
+    """
+        Returns the names of all the tables in the catalog
+    """
+    return sorted([name for name in os.listdir(CATALOG_TABLES_DIR) \
+        if not name.endswith(".tmp")])
+
+def lookup_table(table_name):
+    """
+        Returns the columns of table_name reading only its own catalog entry
+        Returns None if the table doesn't exist
+    """
+    if table_name in COLUMNS_DICT:
+        return COLUMNS_DICT[table_name]
+    if not table_name or os.sep in table_name or table_name.startswith("."):
+        return None
+    try:
+        with open(catalog_table_file(table_name), "r") as f:
+            columns = f.read().splitlines()
+    except IOError:
+        return None
+    add_table_columns(table_name, columns)
+    return columns
+
+def table_exists(table_name):
+    """
+        returns True if table_name is in the catalog
+        returns False otherwise
+    """
+    return lookup_table(table_name) is not None
+
+def import_metadata():
+    """
+        Rebuild the catalog from metadata.txt
+    """
+    del TABLE_NAMES_LIST[:]
+    del COLUMNS_LIST[:]
+    COLUMNS_DICT.clear()
+    parse_metadata()
+
+    version = read_catalog_version()[0]
+    if not os.path.isdir(CATALOG_TABLES_DIR):
+        os.makedirs(CATALOG_TABLES_DIR)
+    for table_name in catalog_table_names():
+        if table_name not in COLUMNS_DICT:
+            os.remove(catalog_table_file(table_name))
     for table_name in TABLE_NAMES_LIST:
-        file_name = table_name + ".csv"
-        records = []
+        write_file_atomically(catalog_table_file(table_name), \
+            "".join([col + "\n" for col in COLUMNS_DICT[table_name]]))
+    write_catalog_version(version + 1)
+
+def open_catalog():
+    """
+        Make sure the catalog is in step with metadata.txt
+        metadata.txt is imported only when it was changed outside the engine
+    """
+    version, stamp = read_catalog_version()
+    if version == 0 or stamp != metadata_stamp():
+        import_metadata()
 
+def catalog_create_table(table_name, column_names):
+    """
+        Add table_name to the catalog and append its metadata to metadata.txt
+    """
+    version = read_catalog_version()[0]
+    write_file_atomically(catalog_table_file(table_name), \
+        "".join([col + "\n" for col in column_names]))
+    with open("metadata.txt", "a") as f:
+        f.write(xml_metadata(table_name, column_names))
+    write_catalog_version(version + 1)
+    add_table_columns(table_name, column_names)
+
+def catalog_drop_table(table_name):
+    """
+        Remove table_name from the catalog and cut its metadata out of metadata.txt
+    """
+    version = read_catalog_version()[0]
+    try:
+        os.remove(catalog_table_file(table_name))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    with open("metadata.txt", "r") as f:
+        tables_data = f.read().split("<begin_table>\n")
+    meta_data = tables_data[0]
+    for table_data in tables_data[1:]:
+        if table_data.split("\n")[0].strip() != table_name:
+            meta_data += "<begin_table>\n" + table_data
+    write_file_atomically("metadata.txt", meta_data)
+    write_catalog_version(version + 1)
+    remove_table_columns(table_name)
+
+# ----------PARSE TABLE DATA----------------
+@contextmanager
+def gc_paused():
+    """
+        Pause the garbage collector while millions of parsed values are created
+        They are never part of a reference cycle, so it would only walk over them
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def make_column(values):
+    """
+        Convert the raw string values of a column into a typed column
+        1. array('l') if every value is an integer that prints back unchanged
+        2. the list of strings itself otherwise
+    """
+    with gc_paused():
+        try:
+            column = array('l', map(int, values))
+        except (ValueError, OverflowError):
+            return values
+
+        # "007" or "+7" would not print back the same, keep such columns as strings
+        if map(str, column) != values:
+            return values
+    return column
+
+def merge_columns(parts):
+    """
+        Concatenate the typed parts of a column in order
+        The result is an integer column only if every part is one
+    """
+    if all([getattr(part, "typecode", None) == "l" for part in parts]):
+        column = array('l')
+        for part in parts:
+            column.extend(part)
+        return column
+
+    column = []
+    for part in parts:
+        if getattr(part, "typecode", None) == "l":
+            column.extend([str(value) for value in part])
+        else:
+            column.extend(part)
+    return column
+
+def encode_column(column):
+    """
+        Choose an encoding for the column from its statistics
+        Returns a RunLengthColumn, a DictionaryColumn or the column itself
+    """
+    length = len(column)
+    if length < ENCODING_MIN_ROWS:
+        return column
+
+    runs = 1 + sum([1 for previous, value in izip(column, islice(column, 1, None)) \
+        if previous != value])
+    if runs * RUN_LENGTH_MIN_RUN <= length:
+        return RunLengthColumn.encode(column)
+
+    distinct = {}
+    limit = min(DICTIONARY_MAX_VALUES, length / DICTIONARY_MIN_REPEAT)
+    for value in column:
+        if value not in distinct:
+            if len(distinct) == limit:
+                return column
+            distinct[value] = len(distinct)
+    return DictionaryColumn.encode(column, distinct)
+
+# A field in single or double quotes, with "" or '' standing for an escaped quote
+QUOTED_FIELD = re.compile(r"""\s*(?:"((?:[^"]|"")*)"|'((?:[^']|'')*)')[^,]*""")
+
+def tokenize_quoted_record(record_data):
+    """
+        Split a csv line which has single quoted fields into its fields
+    """
+    record = []
+    position = 0
+    while True:
+        match = QUOTED_FIELD.match(record_data, position)
+        if match:
+            if match.group(1) is not None:
+                record.append(match.group(1).replace('""', '"'))
+            else:
+                record.append(match.group(2).replace("''", "'"))
+            position = match.end()
+        else:
+            end = record_data.find(",", position)
+            if end == -1:
+                end = len(record_data)
+            record.append(record_data[position:end].strip())
+            position = end
+        if position >= len(record_data):
+            return record
+        # skip the comma
+        position += 1
+
+def tokenize_records(records_data, single_quoted):
+    """
+        Split csv lines into records
+        Double quoted fields are handled by the csv module, lines with single
+        quoted fields by tokenize_quoted_record
+    """
+    if single_quoted:
+        return [tokenize_quoted_record(record_data.rstrip("\r\n")) \
+            for record_data in records_data if record_data.strip()]
+    return filter(None, csv.reader(records_data, skipinitialspace=True))
+
+def split_plain_records(data, number_of_columns):
+    """
+        Split a buffer without quotes and blank lines into columns with bulk
+        string operations on the whole buffer
+        Returns None if the buffer doesn't have exactly number_of_columns fields per line
+    """
+    data = data.replace("\r\n", "\n")
+    if data.endswith("\n"):
+        data = data[:-1]
+    if not data or data.startswith("\n") or "\n\n" in data:
+        return None
+    fields = data.replace("\n", ",").split(",")
+    if len(fields) != (data.count("\n") + 1) * number_of_columns:
+        return None
+    return [fields[i::number_of_columns] for i in xrange(number_of_columns)]
+
+def parse_records(records_data, number_of_columns):
+    """
+        Parse csv lines into a list of raw string columns
+        Records are transposed into columns in bulk, short records are padded with ""
+    """
+    data = "".join(records_data)
+    has_spaces = " " in data or "\t" in data or "\r" in data
+
+    with gc_paused():
+        columns = None
+        if '"' not in data and "'" not in data and (number_of_columns > 1 or not has_spaces):
+            columns = split_plain_records(data, number_of_columns)
+
+        if columns is None:
+            records = tokenize_records(records_data, "'" in data)
+            if has_spaces:
+                # lines holding only spaces are blank lines
+                records = [record for record in records if len(record) > 1 or record[0].strip()]
+            if records and set(map(len, records)) != set([number_of_columns]):
+                padding = [""] * number_of_columns
+                records = [(record + padding)[:number_of_columns] for record in records]
+            if records:
+                columns = map(list, zip(*records))
+            else:
+                columns = [[] for _ in xrange(number_of_columns)]
+
+        if has_spaces:
+            columns = [map(str.strip, column) for column in columns]
+    return columns
+
+def parse_chunk(args):
+    """
+        Parse the lines in the byte range [start, end) of file_name
+        Runs in a worker process, returns typed columns
+    """
+    file_name, start, end, number_of_columns = args
+    with open(file_name, "r") as f:
+        f.seek(start)
+        records_data = f.read(end - start).splitlines(True)
+    return [make_column(column) for column in parse_records(records_data, number_of_columns)]
+
+def chunk_boundaries(file_name, number_of_chunks):
+    """
+        Split file_name into at most number_of_chunks byte ranges
+        Every range starts at the beginning of a line
+    """
+    size = os.path.getsize(file_name)
+    boundaries = [0]
+    with open(file_name, "r") as f:
+        for i in xrange(1, number_of_chunks):
+            offset = size * i / number_of_chunks
+            if offset <= boundaries[-1]:
+                continue
+            f.seek(offset - 1)
+            f.readline()
+            offset = f.tell()
+            if offset >= size:
+                break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+    boundaries.append(size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+def parse_table_data_parallel(table_name, processes):
+    """
+        Parse table_name.csv with a pool of processes and merge the chunks in order
+    """
+    file_name = table_name + ".csv"
+    number_of_columns = len(COLUMNS_DICT[table_name])
+    chunks = [(file_name, start, end, number_of_columns) for start, end in \
+        chunk_boundaries(file_name, processes * LOAD_CHUNKS_PER_PROCESS)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        parts = pool.map(parse_chunk, chunks, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    COLUMN_STORE[table_name] = [merge_columns([part[i] for part in parts]) \
+        for i in xrange(number_of_columns)]
+
+def parse_table_data(table_name):
+    """
+        Parse the data present in table_name.csv into COLUMN_STORE[table_name]
+        Files bigger than PARALLEL_LOAD_THRESHOLD are parsed in parallel
+    """
+    file_name = table_name + ".csv"
+    size = os.path.getsize(file_name)
+    processes = LOAD_PROCESSES
+    start_time = time.time()
+
+    if size > PARALLEL_LOAD_THRESHOLD and processes > 1:
+        parse_table_data_parallel(table_name, processes)
+    else:
+        processes = 1
         with open(file_name, "r") as f:
-            records_data = f.readlines()
-            for record_data in records_data:
-                record = record_data.split(",")
-                for i, col in enumerate(record):
-                    col = col.strip()
-                    if col[0] == '"':
-                        col = col.split('"')[1]
-                    elif col[0] == "'":
-                        col = col.split("'")[1]
-                    record[i] = col
-                records.append(record)
-        RECORDS_DICT[table_name] = records
+            columns = parse_records(f.read().splitlines(True), len(COLUMNS_DICT[table_name]))
+        COLUMN_STORE[table_name] = [make_column(column) for column in columns]
+
+    COLUMN_STORE[table_name] = [encode_column(column) for column in COLUMN_STORE[table_name]]
+    for column_name, column in zip(COLUMNS_DICT[table_name], COLUMN_STORE[table_name]):
+        if isinstance(column, (DictionaryColumn, RunLengthColumn)):
+            debug("encoded %s.%s as %s" % (table_name, column_name, column.describe()))
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    rows = table_length(table_name)
+    debug("loaded %s: %d rows, %.1f MB in %.3f s with %d process(es) "
+          "(%d rows/s, %.1f MB/s)" % (table_name, rows, size / 1048576.0, elapsed, \
+          processes, rows / elapsed, size / 1048576.0 / elapsed))
+
+# ----------ENCODED COLUMNS-----------------
+class DictionaryColumn(object):
+    """
+        Column stored as a dictionary of its distinct values and one code per value
+    """
+
+    def __init__(self, dictionary, codes, counts=None):
+        self.dictionary = dictionary
+        self.codes = codes
+        self.typecode = getattr(dictionary, "typecode", None)
+        self.lookup = None
+        if counts is None:
+            counts = [0] * len(dictionary)
+            for code in codes:
+                counts[code] += 1
+        self.counts = counts
+
+    @staticmethod
+    def encode(column, distinct):
+        """
+            Encode column whose distinct values are numbered in distinct
+        """
+        dictionary = [None] * len(distinct)
+        for value, code in distinct.iteritems():
+            dictionary[code] = value
+        if getattr(column, "typecode", None) == "l":
+            dictionary = array('l', dictionary)
+        codes = array('B' if len(dictionary) <= 256 else 'H', [distinct[value] for value in column])
+        return DictionaryColumn(dictionary, codes)
+
+    def describe(self):
+        return "dictionary (%d values, %d byte codes)" % (len(self.dictionary), self.codes.itemsize)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def values(self, start, stop):
+        """
+            Returns the values in [start, stop) as a list
+        """
+        dictionary = self.dictionary
+        return [dictionary[code] for code in self.codes[start:stop]]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.codes))
+            return self.values(start, stop)[::step]
+        return self.dictionary[self.codes[index]]
+
+    def __iter__(self):
+        dictionary = self.dictionary
+        for code in self.codes:
+            yield dictionary[code]
+
+    def total(self):
+        return sum([cell_value(value) * count for value, count in izip(self.dictionary, self.counts)])
+
+    def minimum(self):
+        return min([cell_value(value) for value, count in izip(self.dictionary, self.counts) if count])
+
+    def maximum(self):
+        return max([cell_value(value) for value, count in izip(self.dictionary, self.counts) if count])
+
+    def positions_equal(self, value):
+        """
+            Returns the ascending positions holding value, decoding only the dictionary
+        """
+        if self.lookup is None:
+            self.lookup = dict([(v, code) for code, v in enumerate(self.dictionary)])
+        code = self.lookup.get(value)
+        if code is None:
+            return []
+        if self.codes.typecode == 'B':
+            # find the code byte with str.find instead of looping over every row
+            data = self.codes.tostring()
+            code = chr(code)
+            positions = []
+            position = data.find(code)
+            while position != -1:
+                positions.append(position)
+                position = data.find(code, position + 1)
+            return positions
+        return [i for i, c in enumerate(self.codes) if c == code]
+
+    def positions_where(self, predicate):
+        """
+            Returns the ascending positions holding a value satisfying predicate,
+            testing every value of the dictionary once
+        """
+        codes = set([code for code, value in enumerate(self.dictionary) if predicate(value)])
+        if len(codes) == 1:
+            return self.positions_equal(self.dictionary[codes.pop()])
+        return [i for i, c in enumerate(self.codes) if c in codes]
+
+class RunLengthColumn(object):
+    """
+        Column stored as runs of equal values
+        run_ends[i] is the position just after the last value of the i-th run
+    """
+
+    def __init__(self, run_values, run_ends):
+        self.run_values = run_values
+        self.run_ends = run_ends
+        self.typecode = getattr(run_values, "typecode", None)
+
+    @staticmethod
+    def encode(column):
+        """
+            Encode column as runs of equal values
+        """
+        run_values = []
+        run_ends = array('l')
+        for i, value in enumerate(column):
+            if run_values and run_values[-1] == value:
+                run_ends[-1] = i + 1
+            else:
+                run_values.append(value)
+                run_ends.append(i + 1)
+        if getattr(column, "typecode", None) == "l":
+            run_values = array('l', run_values)
+        return RunLengthColumn(run_values, run_ends)
+
+    def describe(self):
+        return "run length (%d runs)" % len(self.run_ends)
+
+    def __len__(self):
+        return self.run_ends[-1] if self.run_ends else 0
+
+    def runs(self):
+        """
+            Yields (start, stop, value) of every run
+        """
+        start = 0
+        for stop, value in izip(self.run_ends, self.run_values):
+            yield start, stop, value
+            start = stop
+
+    def values(self, start, stop):
+        """
+            Returns the values in [start, stop) as a list
+        """
+        stop = min(stop, len(self))
+        values = []
+        run = bisect_right(self.run_ends, start)
+        while start < stop:
+            run_stop = min(self.run_ends[run], stop)
+            values.extend([self.run_values[run]] * (run_stop - start))
+            start = run_stop
+            run += 1
+        return values
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return self.values(start, stop)[::step]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("column index out of range")
+        return self.run_values[bisect_right(self.run_ends, index)]
+
+    def __iter__(self):
+        for start, stop, value in self.runs():
+            for _ in xrange(start, stop):
+                yield value
+
+    def total(self):
+        return sum([cell_value(value) * (stop - start) for start, stop, value in self.runs()])
+
+    def minimum(self):
+        return min([cell_value(value) for value in self.run_values])
+
+    def maximum(self):
+        return max([cell_value(value) for value in self.run_values])
+
+    def positions_equal(self, value):
+        """
+            Returns the ascending positions holding value, looking only at the runs
+        """
+        return chain(*[xrange(start, stop) for start, stop, run_value in self.runs() \
+            if run_value == value])
+
+    def positions_where(self, predicate):
+        """
+            Returns the ascending positions holding a value satisfying predicate,
+            testing every run once
+        """
+        return chain(*[xrange(start, stop) for start, stop, run_value in self.runs() \
+            if predicate(run_value)])
+
+# ----------BINARY COLUMN FILES-------------
+class MappedColumn(object):
+    """
+        Read only column backed by a memory mapped binary column file
+        Values are unpacked from the page cache when they are read
+    """
+
+    def __init__(self, file_name):
+        with open(file_name, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, kind, width, length = BINARY_HEADER.unpack_from(self.buf, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION or kind not in "is":
+            raise ValueError(file_name + " is not a plain binary column file")
+        if len(self.buf) != BINARY_HEADER.size + width * length:
+            raise ValueError(file_name + " is truncated")
+        self.kind = kind
+        self.width = width
+        self.length = length
+        self.typecode = "l" if kind == "i" else None
+
+    def __len__(self):
+        return self.length
+
+    def values(self, start, stop):
+        """
+            Returns the values in [start, stop) as a list
+        """
+        start = max(0, min(start, self.length))
+        stop = max(start, min(stop, self.length))
+        offset = BINARY_HEADER.size + start * self.width
+        if self.kind == "i":
+            return list(struct.unpack_from("<%dq" % (stop - start), self.buf, offset))
+        width = self.width
+        return [self.buf[i:i+width].rstrip("\0") \
+            for i in xrange(offset, offset + (stop - start) * width, width)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            return self.values(start, stop)[::step]
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("column index out of range")
+        return self.values(index, index + 1)[0]
+
+    def __iter__(self):
+        for start in xrange(0, self.length, BINARY_CHUNK):
+            for value in self.values(start, start + BINARY_CHUNK):
+                yield value
+
+def binary_column_file(table_name, column_name):
+    """
+        Returns the path of the binary column file of table_name.column_name
+    """
+    return os.path.join(table_name + BINARY_SUFFIX, column_name + ".col")
+
+def binary_schema_file(table_name):
+    """
+        Returns the path of the schema file of the binary column files of table_name
+    """
+    return os.path.join(table_name + BINARY_SUFFIX, "schema")
+
+def binary_schema_matches(table_name):
+    """
+        Returns True if table_name.bin was written for the current columns of table_name
+    """
+    try:
+        with open(binary_schema_file(table_name)) as f:
+            return f.read().split("\n") == list(COLUMNS_DICT[table_name])
+    except (IOError, OSError, KeyError):
+        return False
+
+def write_binary_column(file_name, column):
+    """
+        Write one column to file_name in the binary column format
+        The file is written next to its final place and renamed over it
+        Encoded columns write their dictionary or run values to a second file first
+    """
+    if isinstance(column, DictionaryColumn):
+        write_binary_column(file_name[:-len(".col")] + ".dict", column.dictionary)
+        kind, width, values = "d", column.codes.itemsize, column.codes
+    elif isinstance(column, RunLengthColumn):
+        write_binary_column(file_name[:-len(".col")] + ".runs", column.run_values)
+        kind, width, values = "r", 8, column.run_ends
+    elif getattr(column, "typecode", None) == "l":
+        kind, width, values = "i", 8, column
+    else:
+        kind, width, values = "s", max([len(value) for value in column] or [1]) or 1, column
+
+    with atomically_written_file(file_name) as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, kind, width, len(values)))
+        for start in xrange(0, len(values), BINARY_CHUNK):
+            chunk = values[start:start+BINARY_CHUNK]
+            if kind == "d":
+                if sys.byteorder != "little":
+                    chunk.byteswap()
+                f.write(chunk.tostring())
+            elif kind == "s":
+                f.write("".join([value.ljust(width, "\0") for value in chunk]))
+            else:
+                f.write(struct.pack("<%dq" % len(chunk), *chunk))
+
+def read_binary_column(file_name):
+    """
+        Returns the column stored in file_name
+        Plain columns stay memory mapped, encoded ones are small and read into memory
+    """
+    with open(file_name, "rb") as f:
+        magic, version, kind, width, length = BINARY_HEADER.unpack(f.read(BINARY_HEADER.size))
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(file_name + " is not a binary column file")
+        if kind in "is":
+            return MappedColumn(file_name)
+        data = f.read()
+    if len(data) != width * length:
+        raise ValueError(file_name + " is truncated")
+
+    if kind == "d":
+        codes = array({1: 'B', 2: 'H'}[width])
+        codes.fromstring(data)
+        if sys.byteorder != "little":
+            codes.byteswap()
+        dictionary = read_binary_column(file_name[:-len(".col")] + ".dict")
+        if dictionary.typecode == "l":
+            return DictionaryColumn(array('l', dictionary), codes)
+        return DictionaryColumn(list(dictionary), codes)
+    elif kind == "r":
+        run_ends = array('l', struct.unpack("<%dq" % length, data))
+        run_values = read_binary_column(file_name[:-len(".col")] + ".runs")
+        if run_values.typecode == "l":
+            return RunLengthColumn(array('l', run_values), run_ends)
+        return RunLengthColumn(list(run_values), run_ends)
+    raise ValueError(file_name + " has an unknown kind " + kind)
+
+def write_binary_table(table_name, columns):
+    """
+        Convert the loaded columns of table_name into binary column files
+        Files written for another schema, with their zone maps and indexes, are
+        removed first and the schema file is written last, a directory without
+        one is being written by another process and is written over
+        Failing to write them (read only directory, full disk) is not an error
+        Returns True if they were written, False otherwise
+    """
+    try:
+        if os.path.exists(binary_schema_file(table_name)) \
+            and not binary_schema_matches(table_name):
+            remove_binary_table(table_name)
+        try:
+            os.mkdir(table_name + BINARY_SUFFIX)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        for column_name, column in zip(COLUMNS_DICT[table_name], columns):
+            write_binary_column(binary_column_file(table_name, column_name), column)
+        write_file_atomically(binary_schema_file(table_name), \
+            "\n".join(COLUMNS_DICT[table_name]))
+    except (IOError, OSError, ValueError, struct.error):
+        return False
+    return True
+
+def read_binary_table(table_name):
+    """
+        Returns the columns of table_name read from its binary column files
+        Returns None when the binary files are missing, older than table_name.csv
+        or written for another schema
+    """
+    if not binary_schema_matches(table_name):
+        return None
+    try:
+        csv_mtime = os.path.getmtime(table_name + ".csv")
+        columns = []
+        for column_name in COLUMNS_DICT[table_name]:
+            file_name = binary_column_file(table_name, column_name)
+            if os.path.getmtime(file_name) <= csv_mtime:
+                return None
+            columns.append(read_binary_column(file_name))
+    except (IOError, OSError, ValueError, KeyError, struct.error):
+        return None
+
+    if len(set([len(column) for column in columns])) > 1:
+        return None
+    return columns
+
+def remove_binary_table(table_name):
+    """
+        Remove the binary column files of table_name
+    """
+    shutil.rmtree(table_name + BINARY_SUFFIX, ignore_errors=True)
+
+# ----------SNAPSHOT CACHE------------------
+def snapshot_key(table_name):
+    """
+        Returns the key a snapshot of table_name must have to be valid
+        (path, size and mtime of the csv, schema and the platform array layout)
+    """
+    stat = os.stat(table_name + ".csv")
+    return (SNAPSHOT_VERSION, os.path.abspath(table_name + ".csv"), stat.st_size, \
+        repr(stat.st_mtime), tuple(COLUMNS_DICT[table_name]), sys.byteorder, \
+        array('l').itemsize)
+
+def snapshot_file(key):
+    """
+        Returns the path of the snapshot of the csv in key
+    """
+    return os.path.join(SNAPSHOT_DIR, hashlib.md5(key[1]).hexdigest() + ".snapshot")
+
+def dump_column(column):
+    """
+        Returns column as a tuple of marshallable values
+    """
+    if isinstance(column, DictionaryColumn):
+        return ("d", dump_column(column.dictionary), column.codes.typecode, \
+            column.codes.tostring(), column.counts)
+    elif isinstance(column, RunLengthColumn):
+        return ("r", dump_column(column.run_values), column.run_ends.tostring())
+    elif getattr(column, "typecode", None) == "l":
+        return ("i", array('l', column).tostring())
+    return ("s", list(column))
+
+def undump_column(dumped):
+    """
+        Returns the column dumped by dump_column
+    """
+    if dumped[0] == "d":
+        codes = array(dumped[2])
+        codes.fromstring(dumped[3])
+        return DictionaryColumn(undump_column(dumped[1]), codes, dumped[4])
+    elif dumped[0] == "r":
+        run_ends = array('l')
+        run_ends.fromstring(dumped[2])
+        return RunLengthColumn(undump_column(dumped[1]), run_ends)
+    elif dumped[0] == "i":
+        column = array('l')
+        column.fromstring(dumped[1])
+        return column
+    return dumped[1]
+
+def read_snapshot(table_name):
+    """
+        Returns the columns of table_name from its snapshot
+        Returns None if there is no snapshot or the csv or schema changed since
+    """
+    try:
+        key = snapshot_key(table_name)
+        file_name = snapshot_file(key)
+        with open(file_name, "rb") as f:
+            snapshot = marshal.load(f)
+        if snapshot[0] != key:
+            return None
+        columns = [undump_column(dumped) for dumped in snapshot[1]]
+        # mark the snapshot as recently used
+        os.utime(file_name, None)
+    except (IOError, OSError, EOFError, ValueError, TypeError, IndexError, KeyError):
+        return None
+    return columns
+
+def evict_snapshots():
+    """
+        Remove the least recently used snapshots until SNAPSHOT_DIR fits SNAPSHOT_CACHE_BYTES
+    """
+    snapshots = []
+    for name in os.listdir(SNAPSHOT_DIR):
+        if name.endswith(".tmp"):
+            # being written by another process
+            continue
+        file_name = os.path.join(SNAPSHOT_DIR, name)
+        stat = os.stat(file_name)
+        snapshots.append((stat.st_mtime, stat.st_size, file_name))
+    snapshots.sort()
+    total = sum([size for _, size, _ in snapshots])
+    for _, size, file_name in snapshots:
+        if total <= SNAPSHOT_CACHE_BYTES:
+            break
+        os.remove(file_name)
+        total -= size
+
+def write_snapshot(table_name, columns):
+    """
+        Save the loaded columns of table_name in the snapshot cache
+        Failing to write the snapshot is not an error
+    """
+    try:
+        key = snapshot_key(table_name)
+        if not os.path.isdir(SNAPSHOT_DIR):
+            os.mkdir(SNAPSHOT_DIR)
+        write_file_atomically(snapshot_file(key), \
+            marshal.dumps((key, [dump_column(column) for column in columns])))
+        evict_snapshots()
+    except (IOError, OSError, ValueError):
+        pass
+
+# ----------TABLE LOADING-------------------
+def load_stored_table(table_name):
+    """
+        Returns the columns of table_name from its binary column files, which are
+        memory mapped, or else from the snapshot cache
+        Returns None if neither is up to date
+    """
+    columns = read_binary_table(table_name)
+    if columns is None:
+        columns = read_snapshot(table_name)
+    if columns is not None:
+        COLUMN_STORE[table_name] = columns
+    return columns
+
+def load_table(table_name):
+    """
+        Returns the columns of table_name, loading the table on first use
+        1. Binary column files are used when they are newer than table_name.csv
+        2. A snapshot is used when it matches the current table_name.csv and schema
+        3. Otherwise table_name.csv is parsed and converted to binary column files,
+           it is saved as a snapshot only if they can't be written
+        Loaded tables stay in COLUMN_STORE for the later statements
+    """
+    if table_name not in COLUMN_STORE and load_stored_table(table_name) is None:
+        parse_table_data(table_name)
+        if not write_binary_table(table_name, COLUMN_STORE[table_name]):
+            write_snapshot(table_name, COLUMN_STORE[table_name])
+    return COLUMN_STORE[table_name]
+
+def unload_table(table_name):
+    """
+        Forget the loaded data of table_name
+    """
+    COLUMN_STORE.pop(table_name, None)
+    ZONE_MAPS.pop(table_name, None)
+    COLUMN_INDEXES.pop(table_name, None)
+
+def table_length(table_name):
+    """
+        Returns the number of records in the table
+    """
+    columns = load_table(table_name)
+    if not columns:
+        return 0
+    return len(columns[0])
+
+def estimated_table_length(table_name):
+    """
+        Returns the number of records in the table if it is loaded or stored
+        Otherwise it is estimated from the size of table_name.csv and of its first
+        SCAN_BATCH_SIZE lines, without reading the whole csv
+    """
+    if table_name in COLUMN_STORE or load_stored_table(table_name) is not None:
+        return table_length(table_name)
+    sample_bytes = 0
+    number_of_lines = 0
+    with open(table_name + ".csv", "r") as f:
+        for line in islice(f, SCAN_BATCH_SIZE):
+            sample_bytes += len(line)
+            number_of_lines += 1
+    if number_of_lines < SCAN_BATCH_SIZE:
+        return table_length(table_name)
+    return os.path.getsize(table_name + ".csv") * number_of_lines / sample_bytes
+
+def table_records(table_name, indices=None):
+    """
+        Returns the records of the table as a list of tuples built from COLUMN_STORE
+        With indices, records only have the columns at those indices
+    """
+    columns = load_table(table_name)
+    if indices is None:
+        return zip(*columns)
+    if not indices:
+        return [()] * table_length(table_name)
+    return zip(*[columns[i] for i in indices])
+
+def cell_value(value):
+    """
+        Returns the integer value of a cell
+        Integer columns already hold ints, string columns are converted here
+    """
+    if isinstance(value, basestring):
+        return int(value)
+    return value
+
+# ----------ZONE MAPS-----------------------
+def zone_map_file(table_name, column_name):
+    """
+        Returns the path of the zone map file of table_name.column_name
+    """
+    return os.path.join(table_name + BINARY_SUFFIX, column_name + ".zmap")
+
+def compute_zone_map(column, block_size):
+    """
+        Returns the (min, max) of every block_size values of an integer column
+    """
+    zone_map = []
+    for start in xrange(0, len(column), block_size):
+        block = column[start:start+block_size]
+        zone_map.append((min(block), max(block)))
+    return zone_map
+
+def read_zone_map(file_name, csv_mtime, block_size):
+    """
+        Returns the zone map stored in file_name
+        Returns None if it is missing, stale or built for another block size
+    """
+    try:
+        if os.path.getmtime(file_name) <= csv_mtime:
+            return None
+        with open(file_name, "rb") as f:
+            data = f.read()
+        magic, version, file_block_size, number_of_blocks = \
+            ZONE_MAP_HEADER.unpack_from(data, 0)
+        if magic != ZONE_MAP_MAGIC or version != ZONE_MAP_VERSION \
+            or file_block_size != block_size:
+            return None
+        values = struct.unpack_from("<%dq" % (2 * number_of_blocks), data, ZONE_MAP_HEADER.size)
+    except (IOError, OSError, struct.error):
+        return None
+    return zip(values[0::2], values[1::2])
+
+def write_zone_map(file_name, zone_map, block_size):
+    """
+        Persist zone_map to file_name
+    """
+    values = [value for min_max in zone_map for value in min_max]
+    write_file_atomically(file_name, ZONE_MAP_HEADER.pack(ZONE_MAP_MAGIC, \
+        ZONE_MAP_VERSION, block_size, len(zone_map)) + struct.pack("<%dq" % len(values), *values))
+
+def get_zone_maps(table_name, columns):
+    """
+        Returns the zone maps of the in memory columns of table_name
+        Zone maps are read from table_name.bin when they are up to date,
+        otherwise they are computed and persisted there
+    """
+    if table_name in ZONE_MAPS:
+        return ZONE_MAPS[table_name]
+
+    try:
+        csv_mtime = os.path.getmtime(table_name + ".csv")
+    except OSError:
+        csv_mtime = None
+    persist = csv_mtime is not None and binary_schema_matches(table_name)
+
+    zone_maps = []
+    for column_name, column in zip(COLUMNS_DICT[table_name], columns):
+        if getattr(column, "typecode", None) != "l":
+            zone_maps.append(None)
+            continue
+        file_name = zone_map_file(table_name, column_name)
+        zone_map = None
+        if persist:
+            zone_map = read_zone_map(file_name, csv_mtime, ZONE_MAP_BLOCK_SIZE)
+        if zone_map is None:
+            zone_map = compute_zone_map(column, ZONE_MAP_BLOCK_SIZE)
+            if persist:
+                try:
+                    write_zone_map(file_name, zone_map, ZONE_MAP_BLOCK_SIZE)
+                except (IOError, OSError):
+                    pass
+        zone_maps.append(zone_map)
+
+    ZONE_MAPS[table_name] = zone_maps
+    return zone_maps
+
+def block_may_match(condition_tree, block, zone_maps, column_indices):
+    """
+        returns False if no record of the block can satisfy condition_tree
+        returns True otherwise
+        column_indices maps table_name.column_name to the index of the column
+    """
+    if isinstance(condition_tree, tuple):
+        operator, children = condition_tree
+        if operator == "AND":
+            return all([block_may_match(child, block, zone_maps, column_indices) \
+                for child in children])
+        return any([block_may_match(child, block, zone_maps, column_indices) \
+            for child in children])
+
+    condition = condition_tree
+    index = column_indices.get(str(condition[0]))
+    if index is None or zone_maps[index] is None:
+        return True
+    if str(condition[1]) in LIST_OPERATORS:
+        minimum, maximum = zone_maps[index][block]
+        values = condition_values(condition)
+        if str(condition[1]) == "IN":
+            return any([minimum <= value <= maximum for value in values])
+        elif str(condition[1]) == "BETWEEN":
+            return values[0] <= maximum and values[1] >= minimum
+        return True
+    if not is_int(condition[2]):
+        return True
+    minimum, maximum = zone_maps[index][block]
+    value = int(condition[2])
+    operator = str(condition[1])
+    if operator == "=":
+        return minimum <= value <= maximum
+    elif operator == ">":
+        return maximum > value
+    elif operator == ">=":
+        return maximum >= value
+    elif operator == "<":
+        return minimum < value
+    elif operator == "<=":
+        return minimum <= value
+    return True
+
+# ----------COLUMN INDEXES------------------
+def column_index_file(table_name, column_name):
+    """
+        Returns the path of the index file of table_name.column_name
+    """
+    return os.path.join(table_name + BINARY_SUFFIX, column_name + ".idx")
+
+def compute_column_index(column):
+    """
+        Returns {value: [positions of value]} of column
+    """
+    index = {}
+    for position, value in enumerate(column):
+        value = cell_value(value)
+        if value in index:
+            index[value].append(position)
+        else:
+            index[value] = [position]
+    return index
+
+def read_column_index(file_name, csv_mtime):
+    """
+        Returns the column index stored in file_name
+        Returns None if it is missing or stale
+    """
+    try:
+        if os.path.getmtime(file_name) <= csv_mtime:
+            return None
+        with open(file_name, "rb") as f:
+            magic, version, index = marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if magic != COLUMN_INDEX_MAGIC or version != COLUMN_INDEX_VERSION:
+        return None
+    return index
+
+def get_column_index(table_name, column_index):
+    """
+        Returns the index of the column at column_index of table_name
+        Indexes are read from table_name.bin when they are up to date,
+        otherwise they are computed and persisted there
+    """
+    table_indexes = COLUMN_INDEXES.setdefault(table_name, {})
+    if column_index in table_indexes:
+        return table_indexes[column_index]
+
+    try:
+        csv_mtime = os.path.getmtime(table_name + ".csv")
+    except OSError:
+        csv_mtime = None
+    persist = csv_mtime is not None and binary_schema_matches(table_name)
+
+    file_name = column_index_file(table_name, COLUMNS_DICT[table_name][column_index])
+    index = None
+    if persist:
+        index = read_column_index(file_name, csv_mtime)
+    if index is None:
+        index = compute_column_index(load_table(table_name)[column_index])
+        if persist:
+            try:
+                write_file_atomically(file_name, \
+                    marshal.dumps((COLUMN_INDEX_MAGIC, COLUMN_INDEX_VERSION, index)))
+            except (IOError, OSError, ValueError):
+                pass
+    table_indexes[column_index] = index
+    return index
+
+# ----------SCAN----------------------------
+def scan_source(table_name, stream=False):
+    """
+        Returns the columns of table_name if they are (or can be) held in memory
+        Returns None if the table should be streamed from its csv
+        With stream, a table that is neither loaded nor stored is always streamed
+    """
+    if table_name in COLUMN_STORE:
+        return COLUMN_STORE[table_name]
+    columns = load_stored_table(table_name)
+    if columns is not None:
+        return columns
+    if stream or os.path.getsize(table_name + ".csv") > STREAM_THRESHOLD:
+        return None
+    return load_table(table_name)
+
+def stream_csv_columns(table_name, batch_size):
+    """
+        Read table_name.csv incrementally
+        Yields the typed columns of every batch_size records
+    """
+    number_of_columns = len(COLUMNS_DICT[table_name])
+    with open(table_name + ".csv", "r") as f:
+        records_data = []
+        for record_data in f:
+            records_data.append(record_data)
+            if len(records_data) == batch_size:
+                yield [make_column(column) for column in \
+                    parse_records(records_data, number_of_columns)]
+                records_data = []
+        if records_data:
+            yield [make_column(column) for column in \
+                parse_records(records_data, number_of_columns)]
+
+def table_column_indices(table_name):
+    """
+        Returns {table_name.column_name: index of the column}
+    """
+    column_indices = {}
+    for i, column_name in enumerate(COLUMNS_DICT[table_name]):
+        column_indices[table_name + "." + column_name] = i
+    return column_indices
+
+def zone_map_matches(table_name, columns, condition_tree, column_indices):
+    """
+        Returns a list of whether each block of table_name may satisfy condition_tree
+        judging by the zone maps, the blocks are counted in SCAN_STATS
+    """
+    zone_maps = get_zone_maps(table_name, columns)
+    block_matches = []
+    for block in xrange((len(columns[0]) + ZONE_MAP_BLOCK_SIZE - 1) / ZONE_MAP_BLOCK_SIZE):
+        block_matches.append(block_may_match(condition_tree, block, zone_maps, column_indices))
+    SCAN_STATS["blocks_scanned"] += len(block_matches)
+    SCAN_STATS["blocks_skipped"] += block_matches.count(False)
+    return block_matches
+
+def scan_table(table_name, batch_size=None, conditions=None, stream=False):
+    """
+        Scan the table and yield batches of at most batch_size records
+        Memory used by the scan is bounded by the batch size, not the table size
+        With conditions, blocks whose zone maps can't satisfy them are skipped
+        and counted in SCAN_STATS
+        With stream, a table that is neither loaded nor stored is read from its csv
+    """
+    batch_size = batch_size or SCAN_BATCH_SIZE
+    columns = scan_source(table_name, stream)
+    if columns is None:
+        for batch_columns in stream_csv_columns(table_name, batch_size):
+            yield zip(*batch_columns)
+        return
+
+    length = len(columns[0]) if columns else 0
+    if not conditions or not length:
+        for start in xrange(0, length, batch_size):
+            yield zip(*[column[start:start+batch_size] for column in columns])
+        return
+
+    condition_tree = parse_condition_tree(conditions)
+    column_indices = table_column_indices(table_name)
+    block_matches = zone_map_matches(table_name, columns, condition_tree, column_indices)
+    skipped = block_matches.count(False)
+
+    positions = encoded_equality_positions(condition_tree, columns, column_indices)
+    if positions is not None:
+        positions = [position for position in positions \
+            if block_matches[position / ZONE_MAP_BLOCK_SIZE]]
+        debug("scan %s: %d records selected on encoded columns" % \
+            (table_name, len(positions)))
+        for start in xrange(0, len(positions), batch_size):
+            chunk = positions[start:start+batch_size]
+            yield zip(*[[column[i] for i in chunk] for column in columns])
+    else:
+        for block, may_match in enumerate(block_matches):
+            if may_match:
+                start = block * ZONE_MAP_BLOCK_SIZE
+                yield zip(*[column[start:start+ZONE_MAP_BLOCK_SIZE] for column in columns])
+    debug("scan %s: %d blocks, %d skipped by zone maps" % \
+        (table_name, len(block_matches), skipped))
+
+def encoded_equality_positions(condition_tree, columns, column_indices):
+    """
+        Returns the positions of the records that can satisfy condition_tree judging
+        by the equality, IN and BETWEEN conditions on encoded integer columns that all
+        records must meet
+        Returns None if there are no such conditions
+    """
+    if isinstance(condition_tree, tuple):
+        if condition_tree[0] != "AND":
+            return None
+        conjuncts = condition_tree[1]
+    else:
+        conjuncts = [condition_tree]
+
+    positions = None
+    for condition in conjuncts:
+        if isinstance(condition, tuple) or str(condition[1]) not in ("=", "IN", "BETWEEN") \
+            or not (is_int(condition[2]) or str(condition[1]) in LIST_OPERATORS):
+            continue
+        index = column_indices.get(str(condition[0]))
+        if index is None:
+            continue
+        column = columns[index]
+        if not isinstance(column, (DictionaryColumn, RunLengthColumn)) \
+            or column.typecode != "l":
+            continue
+        if str(condition[1]) == "IN":
+            values = set(condition_values(condition))
+            matching = column.positions_where(lambda value: value in values)
+        elif str(condition[1]) == "BETWEEN":
+            low, high = condition_values(condition)
+            matching = column.positions_where(lambda value: low <= value <= high)
+        else:
+            matching = column.positions_equal(int(condition[2]))
+        if positions is None:
+            positions = list(matching)
+        else:
+            matching = set(matching)
+            positions = [position for position in positions if position in matching]
+    return positions
+
+def scan_column(table_name, index):
+    """
+        Yields the column at index of the table in one or more pieces
+    """
+    columns = scan_source(table_name)
+    if columns is None:
+        for batch_columns in stream_csv_columns(table_name, SCAN_BATCH_SIZE):
+            yield batch_columns[index]
+        return
+    yield columns[index]
+
+# ----------VECTORIZED EXECUTION------------
+def vectorized():
+    """
+        returns True if NumPy is available and vectorized execution is enabled
+    """
+    return numpy is not None and bool(VECTORIZED)
+
+def numpy_column(column):
+    """
+        Returns the values of a plain or memory mapped integer column as a NumPy
+        array of 8 byte ints sharing the memory of the column
+        Returns None if the column is not an integer column or is encoded
+    """
+    if getattr(column, "typecode", None) != "l" \
+        or isinstance(column, (DictionaryColumn, RunLengthColumn)):
+        return None
+    if not len(column):
+        return numpy.zeros(0, dtype=numpy.int64)
+    if isinstance(column, MappedColumn):
+        return numpy.frombuffer(column.buf, dtype="<i8", count=len(column), \
+            offset=BINARY_HEADER.size)
+    return numpy.frombuffer(column, dtype=numpy.int_)
+
+def numpy_values(column, selection):
+    """
+        Returns the values of an integer column at selection, a slice or an array of
+        positions, as a NumPy array of 8 byte ints
+        Encoded columns decode only the selected values
+        Returns None if the column is not an integer column
+    """
+    if getattr(column, "typecode", None) != "l":
+        return None
+    if isinstance(column, DictionaryColumn):
+        codes = numpy.frombuffer(column.codes, dtype=column.codes.typecode)
+        return numpy_column(column.dictionary)[codes[selection]]
+    if isinstance(column, RunLengthColumn):
+        if isinstance(selection, slice):
+            selection = numpy.arange(*selection.indices(len(column)))
+        runs = numpy.searchsorted(numpy_column(column.run_ends), selection, side="right")
+        return numpy_column(column.run_values)[runs]
+    return numpy_column(column)[selection]
+
+def condition_mask(condition_tree, operand):
+    """
+        Returns the boolean mask of the records satisfying condition_tree, AND and OR
+        combine the masks of the children with & and |
+        operand(name) returns the array of a column or None
+        Returns None if a condition uses a column that is not an integer column
+        or a constant that doesn't fit in 8 bytes
+    """
+    if isinstance(condition_tree, tuple):
+        operator, children = condition_tree
+        mask = None
+        for child in children:
+            child_mask = condition_mask(child, operand)
+            if child_mask is None:
+                return None
+            if mask is None:
+                mask = child_mask
+            elif operator == "AND":
+                mask = mask & child_mask
+            else:
+                mask = mask | child_mask
+        return mask
+
+    condition = condition_tree
+    left = operand(str(condition[0]))
+    if left is None:
+        return None
+    if str(condition[1]) in LIST_OPERATORS:
+        values = condition_values(condition)
+        if not all([-2 ** 63 <= value < 2 ** 63 for value in values]):
+            return None
+        if str(condition[1]) == "BETWEEN":
+            return (left >= values[0]) & (left <= values[1])
+        mask = numpy.in1d(left, numpy.array(values, dtype=numpy.int64))
+        return mask if str(condition[1]) == "IN" else ~mask
+    if len(condition[2].split(".")) > 1:
+        right = operand(str(condition[2]))
+        if right is None:
+            return None
+    else:
+        right = int(condition[2])
+        if not -2 ** 63 <= right < 2 ** 63:
+            return None
+    compare = COMPARISONS.get(str(condition[1]))
+    if compare is None:
+        return numpy.zeros(len(left), dtype=bool)
+    return compare(left, right)
+
+def vectorized_scan(table_name, conditions, batch_size=None):
+    """
+        Returns a generator of the batches of the records of table_name that satisfy
+        conditions, which are evaluated as masks over integer columns
+        Like scan_table, only the blocks that the zone maps can't rule out are masked,
+        or only the positions selected on encoded columns when there are some
+        Returns None if it can't be done, i.e. NumPy is missing, the table is
+        streamed or conditions use columns that are not integer columns
+    """
+    if not vectorized() or not conditions:
+        return None
+    columns = scan_source(table_name)
+    if not columns or not len(columns[0]):
+        return None
+    length = len(columns[0])
+    condition_tree = parse_condition_tree(conditions)
+    column_indices = table_column_indices(table_name)
+
+    def selection_mask(selection):
+        def operand(column_name):
+            if column_name not in column_indices:
+                return None
+            return numpy_values(columns[column_indices[column_name]], selection)
+        return condition_mask(condition_tree, operand)
+
+    if selection_mask(slice(0, 0)) is None:
+        return None
+    block_matches = zone_map_matches(table_name, columns, condition_tree, column_indices)
+    positions = encoded_equality_positions(condition_tree, columns, column_indices)
+    if positions is not None:
+        selections = [numpy.array([position for position in positions \
+            if block_matches[position / ZONE_MAP_BLOCK_SIZE]], dtype=numpy.int64)]
+    else:
+        # consecutive blocks are masked together
+        selections = []
+        for block, may_match in enumerate(block_matches):
+            if not may_match:
+                continue
+            start = block * ZONE_MAP_BLOCK_SIZE
+            stop = min(start + ZONE_MAP_BLOCK_SIZE, length)
+            if selections and selections[-1].stop == start:
+                selections[-1] = slice(selections[-1].start, stop)
+            else:
+                selections.append(slice(start, stop))
+
+    selected = []
+    for selection in selections:
+        mask = selection_mask(selection)
+        if isinstance(selection, slice):
+            selected.append(numpy.flatnonzero(mask) + selection.start)
+        else:
+            selected.append(selection[mask])
+    positions = numpy.concatenate(selected).tolist() if selected else []
+    debug("vectorized scan %s: %d of %d records selected, %d of %d blocks skipped " \
+        "by zone maps" % (table_name, len(positions), length, \
+        block_matches.count(False), len(block_matches)))
+
+    def record_batches():
+        size = batch_size or SCAN_BATCH_SIZE
+        for start in xrange(0, len(positions), size):
+            chunk = positions[start:start+size]
+            yield zip(*[[column[i] for i in chunk] for column in columns])
+    return record_batches()
 
 def pre_parse_data():
     """
-        Pre-Parse the metadata and tables
-        1. Fill TABLE_NAMES_LIST with Table Names
-        2. Fill COLUMNS_LIST with List of Columns of Tables
-        3. Fill COLUMNS_DICT
-        4. Fill RECORDS_DICT
+        Pre-Parse the metadata
+        1. Open the catalog, importing metadata.txt if it changed
+        Table schemas are looked up in the catalog and table data is loaded
+        into COLUMN_STORE only when a query references them
     """
-    parse_metadata()
-    parse_data()
+    open_catalog()
 
 # ------------SQL STATEMENTS----------------
-def format_sql_statements(sql_statements):
+def split_sql_statements(sql_statements):
     """
-        FORMAT and PARSE the sql_statements using sqlparse
+        Split sql_statements into a list of SQL statements without the ";"
     """
     sql_statements = sql_statements.strip()
     # Create a list of SQL statements with delimiter as ";"
-    sql_statements = sqlparse.split(SQL_STMNTS)
+    sql_statements = sqlparse.split(sql_statements)
     # print "sqls",sql_statements
 
     for i, sql_statement in enumerate(sql_statements):
         sql_statements[i] = sql_statement.strip()
 
     for i, sql_statement in enumerate(sql_statements):
-        # Format the SQL Statement by making all the Keywords uppercase
-        # Keywords --> SELECT, WHERE, FROM
         if sql_statement[-1] == ';':
             sql_statements[i] = sql_statement[:-1]
-            sql_statement = sql_statements[i]
-        sql_statements[i] = sqlparse.format(sql_statement, keyword_case='upper')
-        sql_statements[i] = sqlparse.parse(sql_statements[i])[0]
-        # print sql_statements[i].tokens
     return sql_statements
 
+def parse_sql_statement(sql_statement):
+    """
+        FORMAT and PARSE the sql_statement using sqlparse
+    """
+    # Format the SQL Statement by making all the Keywords uppercase
+    # Keywords --> SELECT, WHERE, FROM
+    sql_statement = sqlparse.format(sql_statement, keyword_case='upper')
+    return sqlparse.parse(sql_statement)[0]
+
 def get_tokens(sql):
     """
         Return all tokens present in the given parse_sql statement
@@ -184,20 +1835,18 @@ def xml_metadata(table_name, column_names):
 def create_table(table_name, column_names):
     """
         Creates Table with name as table_name with columns as column_names
-        1. Adds relevant meta_data about the table to metadata.txt
+        1. Adds the table to the catalog and its meta_data to metadata.txt
         2. Creates a file table_name.csv
-    """
-    meta_data = xml_metadata(table_name, column_names)
-    file_name = str(table_name).strip() + ".csv"
-    with open("metadata.txt", "a") as f:
-        f.write(meta_data)
-    os.system("touch " + file_name)
+    """
+    table_name = str(table_name).strip()
+    file_name = table_name + ".csv"
+    catalog_create_table(table_name, column_names)
+    open(file_name, "a").close()
 
 def drop_table(table_name):
     """
         Drops the table with name as table_name
-        1. Removes the meta_data related to table_name
-            i. Rewrite the metadata.txt omitting the metadata related to table_name
+        1. Removes the table from the catalog and its meta_data from metadata.txt
         2. Removes the file table_name.csv
     """
 
@@ -211,16 +1860,9 @@ def drop_table(table_name):
                 check the table name and tru again."
             print "Related metadata will be removed if exists"
 
-    os.remove("metadata.txt")
-    os.system("touch metadata.txt")
-    meta_data = ""
-
-    for table in TABLE_NAMES_LIST:
-        if table != table_name:
-            meta_data += xml_metadata(table, COLUMNS_DICT[table])
-
-    with open("metadata.txt", "a") as f:
-        f.write(meta_data)
+    catalog_drop_table(table_name)
+    unload_table(table_name)
+    remove_binary_table(table_name)
 
 def ddl_execute(ddl_keyword, none_identifiers):
     """
@@ -251,26 +1893,45 @@ def execute_aggregate_query(aggregate_keyword, query_tables, query_column):
         4. SELECT MIN(A) FROM table1, table2
     """
 
-    sum = 0
+    total = 0
     number_of_records = 0
     maximum = -99999999
     minimum = 99999999
     for table in query_tables:
-        number_of_records += len(RECORDS_DICT[table])
-        for record in RECORDS_DICT[table]:
-            for i, col in enumerate(COLUMNS_DICT[table]):
-                if col == query_column:
-                    sum += int(record[i])
-                    maximum = max(maximum, int(record[i]))
-                    minimum = min(minimum, int(record[i]))
-                    break
+        if query_column not in COLUMNS_DICT[table]:
+            number_of_records += table_length(table)
+            continue
+        for column in scan_column(table, COLUMNS_DICT[table].index(query_column)):
+            number_of_records += len(column)
+            if isinstance(column, (DictionaryColumn, RunLengthColumn)):
+                # work on the distinct values or runs instead of every record
+                if len(column):
+                    total += column.total()
+                    maximum = max(maximum, column.maximum())
+                    minimum = min(minimum, column.minimum())
+                continue
+            values = numpy_column(column) if vectorized() else None
+            if values is not None and len(values):
+                column_minimum, column_maximum = int(values.min()), int(values.max())
+                # the sum of 8 byte ints is exact if it can't overflow
+                if len(values) * max(abs(column_minimum), abs(column_maximum)) < 2 ** 63:
+                    total += int(values.sum())
+                    maximum = max(maximum, column_maximum)
+                    minimum = min(minimum, column_minimum)
+                    continue
+            if getattr(column, "typecode", None) != "l":
+                column = [int(value) for value in column]
+            if column:
+                total += sum(column)
+                maximum = max(maximum, max(column))
+                minimum = min(minimum, min(column))
 
     if aggregate_keyword == "SUM":
         print "SUM(" + query_column + ")"
-        print sum
+        print total
     elif aggregate_keyword == "AVG":
         print "AVG(" + query_column + ")"
-        print "%.2f" % (float(sum)/number_of_records)
+        print "%.2f" % (float(total)/number_of_records)
     elif aggregate_keyword == "COUNT":
         print "COUNT(" + query_column + ")"
         print number_of_records
@@ -299,7 +1960,7 @@ def get_query_tables_and_columns(wildcard_token, none_identifiers):
     modified_query_tables = []
     for i, table in enumerate(query_tables):
         table_keyerrors = 0
-        if query_tables[i] not in TABLE_NAMES_LIST:
+        if not table_exists(query_tables[i]):
             table_keyerrors += 1
             print "table " + query_tables[i] + " doesn't exist"
         else:
@@ -353,49 +2014,885 @@ def get_query_tables_and_columns(wildcard_token, none_identifiers):
 def join_util(all_records, present_table_records):
     """
         Helper Function for joining tables
+        Yields the combination of every record in all_records with every record
+        of the next table one at a time, all_records may itself be a generator
     """
-
-    modified_all_records = []
-    if not all_records:
-        for present_table_record in present_table_records:
-            new_record = []
-            new_record.append(present_table_record)
-            modified_all_records.append(new_record)
-        return modified_all_records
-
     for record in all_records:
         for present_table_record in present_table_records:
-            new_record = []
-            for col in record:
-                new_record.append(col)
-            new_record.append(present_table_record)
-            modified_all_records.append(new_record)
-    return modified_all_records
+            yield record + present_table_record
+
+def batch_records(records, batch_size=None):
+    """
+        Yields the records in lists of at most batch_size records
+    """
+    batch_size = batch_size or SCAN_BATCH_SIZE
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
 
-def join_tables(table_names):
+def join_tables(table_names, conditions=None, table_conditions=None, query_columns=None):
     """
         Joins all the tables present in table_names list
+        Conditions comparing columns of two tables which every record must satisfy
+        are executed as hash or sort-merge joins
+        table_conditions[table_name] are applied to the records of table_name
+        before it is joined
+        With query_columns, only they and the columns used by conditions are
+        carried through the join
+        Returns the batches of joined records, produced lazily so that memory
+        doesn't grow with the number of combinations, and their column names
+    """
+    needed_columns = None
+    if query_columns is not None:
+        needed_columns = set(query_columns) | condition_columns(conditions)
+    join_conditions = find_join_conditions(conditions, table_names)
+    all_records, column_names = execute_joins(table_names, join_conditions, \
+        table_conditions, needed_columns)
+    return batch_records(all_records), column_names
+
+def condition_columns(conditions):
+    """
+        Returns the set of column names used by conditions
+    """
+    columns = set()
+    for condition in conditions or []:
+        if isinstance(condition, list):
+            columns.add(str(condition[0]))
+            if compares_columns(condition):
+                columns.add(str(condition[2]))
+    return columns
+
+def find_join_conditions(conditions, table_names):
     """
-    all_records = []
+        Returns [table_name.col, operator, other_table_name.other_col] conditions joining
+        two different tables that every record must satisfy, i.e. that are not under an OR
+    """
+    if not conditions or len(set(table_names)) != len(table_names):
+        return []
+
+    condition_tree = parse_condition_tree(conditions)
+    if isinstance(condition_tree, tuple):
+        if condition_tree[0] != "AND":
+            return []
+        conjuncts = condition_tree[1]
+    else:
+        conjuncts = [condition_tree]
+
+    join_conditions = []
+    for condition in conjuncts:
+        if isinstance(condition, tuple) or str(condition[1]) not in FLIPPED_OPERATORS:
+            continue
+        left, right = str(condition[0]).split("."), str(condition[2]).split(".")
+        if len(left) != 2 or len(right) != 2 or left[0] == right[0]:
+            continue
+        if left[0] in table_names and right[0] in table_names \
+            and left[1] in COLUMNS_DICT[left[0]] and right[1] in COLUMNS_DICT[right[0]]:
+            join_conditions.append(condition)
+    return join_conditions
+
+def condition_tables(condition_tree, column_tables):
+    """
+        Returns the set of tables whose columns appear in condition_tree
+        Returns None if it uses a column that is not in column_tables
+    """
+    if isinstance(condition_tree, tuple):
+        tables = set()
+        for child in condition_tree[1]:
+            child_tables = condition_tables(child, column_tables)
+            if child_tables is None:
+                return None
+            tables |= child_tables
+        return tables
+
+    condition = condition_tree
+    operands = [str(condition[0])]
+    if compares_columns(condition):
+        operands.append(str(condition[2]))
+    tables = set()
+    for operand in operands:
+        if operand not in column_tables:
+            return None
+        tables.add(column_tables[operand])
+    return tables
+
+def push_down_conditions(conditions, table_names):
+    """
+        Splits conditions into filters on a single table and the conditions left
+        for the joined records
+        Only conjuncts, i.e. conditions not under an OR, that use the columns of
+        a single table are pushed down
+        Returns ({table_name: conditions}, remaining_conditions)
+    """
+    if not conditions or len(set(table_names)) != len(table_names):
+        return {}, conditions
 
+    column_tables = {}
     for table_name in table_names:
-        present_table_records = RECORDS_DICT[table_name]
-        all_records = join_util(all_records, present_table_records)
+        for column_name in qualified_column_names([table_name]):
+            column_tables[column_name] = table_name
+
+    condition_tree = parse_condition_tree(conditions)
+    if isinstance(condition_tree, tuple) and condition_tree[0] == "AND":
+        conjuncts = condition_tree[1]
+    else:
+        conjuncts = [condition_tree]
+
+    table_conjuncts = {}
+    remaining = []
+    for conjunct in conjuncts:
+        tables = condition_tables(conjunct, column_tables)
+        if tables is not None and len(tables) == 1:
+            table_conjuncts.setdefault(tables.pop(), []).append(conjunct)
+        else:
+            remaining.append(conjunct)
+
+    table_conditions = {}
+    for table_name, conjuncts in table_conjuncts.items():
+        table_conditions[table_name] = flatten_condition_tree(("AND", conjuncts))
+        debug("push down %s: %s" % (table_name, " ".join( \
+            [element if isinstance(element, str) else " ".join(element) \
+            for element in table_conditions[table_name]])))
+    if not remaining:
+        return table_conditions, []
+    return table_conditions, flatten_condition_tree(("AND", remaining))
+
+# a op b is the same as b FLIPPED_OPERATORS[op] a
+FLIPPED_OPERATORS = {"=": "=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+def is_sorted(keys):
+    """
+        returns True if keys are in non decreasing order
+        returns False otherwise
+    """
+    return all([previous <= key for previous, key in izip(keys, islice(keys, 1, None))])
+
+def hash_join(all_records, present_table_records, key_indices):
+    """
+        Joins the records joined so far with the records of the next table
+        key_indices is a list of (index in all_records, index in present_table_records)
+        whose values must be equal
+        The hash table is built on the next table and probed with all_records in order,
+        so records come out in the same order as in the cross product
+        all_records may be a generator, joined records are yielded one at a time
+    """
+    if not present_table_records:
+        return
 
-    for i, record in enumerate(all_records):
-        new_record = []
-        for x in record:
-            new_record += x
-        all_records[i] = new_record
+    all_indices = [all_index for all_index, _ in key_indices]
+    present_indices = [present_index for _, present_index in key_indices]
+
+    if isinstance(present_table_records, ScannedRecords):
+        hash_table_bytes = present_table_records.estimated_bytes
+    else:
+        hash_table_bytes = estimate_hash_table_bytes(present_table_records)
+    if hash_table_bytes > HASH_JOIN_MEMORY:
+        number_of_partitions = min(GRACE_MAX_PARTITIONS, \
+            2 * hash_table_bytes / HASH_JOIN_MEMORY + 1)
+        debug("hash join: hash table of ~%d bytes, spilling to %d partitions" % \
+            (hash_table_bytes, number_of_partitions))
+        for record in grace_hash_join(all_records, present_table_records, \
+            all_indices, present_indices, number_of_partitions):
+            yield record
+        return
 
-    modified_column_names = []
+    if PARALLEL_JOIN_THRESHOLD and len(present_table_records) >= PARALLEL_JOIN_THRESHOLD \
+        and JOIN_PROCESSES > 1 and JOIN_PARTITIONS > 1:
+        for record in parallel_hash_join(all_records, present_table_records, \
+            all_indices, present_indices):
+            yield record
+        return
+
+    hash_table = {}
+    for present_table_record in present_table_records:
+        key = tuple([cell_value(present_table_record[i]) for i in present_indices])
+        if key in hash_table:
+            hash_table[key].append(present_table_record)
+        else:
+            hash_table[key] = [present_table_record]
+
+    for record in all_records:
+        matches = hash_table.get(tuple([cell_value(record[i]) for i in all_indices]))
+        if matches:
+            for present_table_record in matches:
+                yield record + present_table_record
+
+def estimate_hash_table_bytes(records):
+    """
+        Returns the estimated size in bytes of a hash table holding records,
+        judging by the size of the first SCAN_BATCH_SIZE records
+    """
+    sample = records[:SCAN_BATCH_SIZE]
+    sample_bytes = 0
+    for record in sample:
+        sample_bytes += sys.getsizeof(record) + HASH_ENTRY_BYTES
+        for value in record:
+            sample_bytes += sys.getsizeof(value)
+    return sample_bytes * len(records) / len(sample)
+
+def spill_partitions(records, key_indices, number_of_partitions, file_name):
+    """
+        Writes (position, record) for every record to the file_name.<partition>
+        file of its key, in batches so that about SCAN_BATCH_SIZE records are
+        buffered in all
+        Returns the names of the partition files
+    """
+    file_names = ["%s.%d" % (file_name, i) for i in xrange(number_of_partitions)]
+    files = [open(partition_file_name, "wb") for partition_file_name in file_names]
+    buffers = [[] for _ in xrange(number_of_partitions)]
+    batch_size = max(1, SCAN_BATCH_SIZE / number_of_partitions)
+    try:
+        for position, record in enumerate(records):
+            key = tuple([cell_value(record[i]) for i in key_indices])
+            partition = hash(key) % number_of_partitions
+            buffers[partition].append((position, record))
+            if len(buffers[partition]) == batch_size:
+                marshal.dump(buffers[partition], files[partition])
+                buffers[partition] = []
+        for f, buffer in izip(files, buffers):
+            if buffer:
+                marshal.dump(buffer, f)
+    finally:
+        for f in files:
+            f.close()
+    return file_names
+
+def read_spilled_records(file_name):
+    """
+        Yields the records written to file_name by spill_partitions
+    """
+    with open(file_name, "rb") as f:
+        while True:
+            try:
+                batch = marshal.load(f)
+            except EOFError:
+                return
+            for item in batch:
+                yield item
+
+def grace_hash_join(all_records, present_table_records, all_indices, present_indices, \
+    number_of_partitions):
+    """
+        Hash join that partitions both inputs on the join key into temporary files
+        Only the hash table of one partition of present_table_records is in memory
+        at a time, present_table_records may be ScannedRecords which are partitioned
+        straight from the scan of their table, the joined records of every partition
+        are written to a file in order and the files are merged on the positions of
+        the records in both inputs, so records come out in the same order as in the
+        cross product
+        A single key more frequent than the memory allows still goes to one partition
+    """
+    directory = tempfile.mkdtemp(prefix="mini_sql_join")
+    try:
+        partitions = spill_join_partitions(all_records, present_table_records, \
+            all_indices, present_indices, number_of_partitions, directory)
+        output_files = [join_spilled_partition(partition) for partition in partitions]
+        for record in merge_joined_partitions(output_files):
+            yield record
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def spill_join_partitions(all_records, present_table_records, all_indices, present_indices, \
+    number_of_partitions, directory):
+    """
+        Partitions both inputs of a hash join on the join key into files in directory
+        Returns the arguments of join_spilled_partition for every partition where
+        both inputs have records
+    """
+    present_files = spill_partitions(present_table_records, present_indices, \
+        number_of_partitions, os.path.join(directory, "build"))
+    all_files = spill_partitions(all_records, all_indices, \
+        number_of_partitions, os.path.join(directory, "probe"))
+    # the merge of the outputs holds one batch of every output file
+    batch_size = max(1, SCAN_BATCH_SIZE / number_of_partitions)
+    partitions = []
+    for partition in xrange(number_of_partitions):
+        if os.path.getsize(present_files[partition]) and os.path.getsize(all_files[partition]):
+            partitions.append((all_files[partition], present_files[partition], \
+                os.path.join(directory, "output.%d" % partition), all_indices, \
+                present_indices, batch_size))
+    return partitions
+
+def join_spilled_partition(args):
+    """
+        Hash join of one partition of both inputs written by spill_join_partitions
+        Writes (position, position, joined record) for every joined record to the
+        output file in the order of the cross product, in batches of batch_size
+        Returns the name of the output file
+        Runs in a worker process for parallel_hash_join
+    """
+    all_file_name, present_file_name, output_file_name, all_indices, present_indices, \
+        batch_size = args
+    hash_table = {}
+    for position, present_table_record in read_spilled_records(present_file_name):
+        key = tuple([cell_value(present_table_record[i]) for i in present_indices])
+        if key in hash_table:
+            hash_table[key].append((position, present_table_record))
+        else:
+            hash_table[key] = [(position, present_table_record)]
+    os.remove(present_file_name)
+
+    with open(output_file_name, "wb") as f:
+        output = []
+        for all_position, record in read_spilled_records(all_file_name):
+            matches = hash_table.get(tuple([cell_value(record[i]) for i in all_indices]))
+            if not matches:
+                continue
+            for position, present_table_record in matches:
+                output.append((all_position, position, record + present_table_record))
+            if len(output) >= batch_size:
+                marshal.dump(output, f)
+                output = []
+        if output:
+            marshal.dump(output, f)
+    os.remove(all_file_name)
+    return output_file_name
+
+def merge_joined_partitions(output_files):
+    """
+        Yields the joined records of the output files of join_spilled_partition
+        merged on their positions, in the order of the cross product
+    """
+    for _, _, record in heapq.merge(*[read_spilled_records(output_file_name) \
+        for output_file_name in output_files]):
+        yield record
+
+def parallel_hash_join(all_records, present_table_records, all_indices, present_indices):
+    """
+        Hash join that partitions both inputs on the join key into temporary files
+        and joins the partitions with a pool of JOIN_PROCESSES processes
+        With JOIN_ORDERED the outputs of the partitions are merged lazily on the
+        positions of the records in both inputs, so records come out in the same
+        order as in the cross product, otherwise every output is read as soon
+        as its partition is joined
+    """
+    directory = tempfile.mkdtemp(prefix="mini_sql_join")
+    try:
+        partitions = spill_join_partitions(all_records, present_table_records, \
+            all_indices, present_indices, JOIN_PARTITIONS, directory)
+        debug("hash join: %d partitions joined by %d processes" % \
+            (len(partitions), JOIN_PROCESSES))
+
+        pool = multiprocessing.Pool(JOIN_PROCESSES)
+        try:
+            if JOIN_ORDERED:
+                output_files = pool.map(join_spilled_partition, partitions, 1)
+                for record in merge_joined_partitions(output_files):
+                    yield record
+            else:
+                for output_file_name in pool.imap_unordered(join_spilled_partition, \
+                    partitions, 1):
+                    for _, _, record in read_spilled_records(output_file_name):
+                        yield record
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def merge_join(all_records, present_table_records, all_index, present_index, operator):
+    """
+        Joins the records joined so far with the records of the next table on
+        all_records[i][all_index] operator present_table_records[j][present_index]
+        The next table is sorted on its key unless it already is, every record of
+        all_records then matches one contiguous range of it. The range is found by
+        walking forward when all_records are sorted on their key too (merge) and by
+        binary search otherwise
+        Records come out in the same order as in the cross product, one at a time
+    """
+    if not present_table_records:
+        return
+
+    present_keys = [cell_value(record[present_index]) for record in present_table_records]
+    if is_sorted(present_keys):
+        order = None
+        sorted_keys = present_keys
+    else:
+        order = sorted(xrange(len(present_keys)), key=present_keys.__getitem__)
+        sorted_keys = [present_keys[i] for i in order]
+
+    # all_records can only be checked for order when it is a list
+    merge = False
+    if isinstance(all_records, list):
+        all_keys = [cell_value(record[all_index]) for record in all_records]
+        merge = is_sorted(all_keys)
+
+    # sorted_keys[:low] < key, sorted_keys[low:high] == key, sorted_keys[high:] > key
+    length = len(sorted_keys)
+    low = high = 0
+    for record in all_records:
+        key = cell_value(record[all_index])
+        if merge:
+            while low < length and sorted_keys[low] < key:
+                low += 1
+            high = max(high, low)
+            while high < length and sorted_keys[high] <= key:
+                high += 1
+        else:
+            low = bisect_left(sorted_keys, key)
+            high = bisect_right(sorted_keys, key, low)
+
+        if operator == "=":
+            start, stop = low, high
+        elif operator == "<":
+            start, stop = high, length
+        elif operator == "<=":
+            start, stop = low, length
+        elif operator == ">":
+            start, stop = 0, low
+        else:
+            start, stop = 0, high
+        if start >= stop:
+            continue
+
+        if order is None:
+            matches = present_table_records[start:stop]
+        else:
+            matches = [present_table_records[i] for i in sorted(order[start:stop])]
+        for present_table_record in matches:
+            yield record + present_table_record
+
+def filtered_table_records(table_name, conditions=None, indices=None, semi_joins=None):
+    """
+        Returns the records of table_name that satisfy conditions
+        semi_joins is a list of (column_name, index, keys), records whose
+        value at index is not in keys are dropped
+        With indices, only the columns at those indices of the remaining records are kept
+    """
+    if not conditions and not semi_joins:
+        return table_records(table_name, indices)
+    present_table_records = []
+    for records in filtered_record_batches(table_name, conditions, indices, semi_joins):
+        present_table_records += records
+    debug("filter %s: %d records before the join" % (table_name, len(present_table_records)))
+    return present_table_records
+
+def filtered_record_batches(table_name, conditions=None, indices=None, semi_joins=None, \
+    stream=False):
+    """
+        Yields the records of filtered_table_records in batches read from the scan
+        of table_name, with stream it doesn't load table_name into memory
+    """
+    record_batches = scan_table(table_name, conditions=conditions, stream=stream)
+    if conditions:
+        column_names_dict = {}
+        for i, column_name in enumerate(qualified_column_names([table_name])):
+            column_names_dict[column_name] = i
+        record_batches = filter_records(record_batches, conditions, column_names_dict)
+
+    semi_joins = semi_joins or []
+    eliminated = [0] * len(semi_joins)
+    for records in record_batches:
+        for i, (column_name, index, keys) in enumerate(semi_joins):
+            number_of_records = len(records)
+            records = [record for record in records if cell_value(record[index]) in keys]
+            eliminated[i] += number_of_records - len(records)
+        if indices is not None:
+            records = [tuple([record[i] for i in indices]) for record in records]
+        yield records
+    for (column_name, _, _), count in izip(semi_joins, eliminated):
+        debug("semi-join %s: key filter eliminated %d records" % (column_name, count))
+
+def table_records_bytes(table_name, indices=None):
+    """
+        Returns the estimated size in bytes of a hash table holding the records of
+        table_name with the columns at indices, judging by its first records
+        A table that is neither loaded nor stored is not read past them
+    """
+    sample = next(scan_table(table_name, stream=True), [])
+    if not sample:
+        return 0
+    if indices is not None:
+        sample = [tuple([record[i] for i in indices]) for record in sample]
+    return estimate_hash_table_bytes(sample) * estimated_table_length(table_name) / len(sample)
+
+class ScannedRecords(object):
+    """
+        The records filtered_table_records would return for a table too big to be
+        held in memory, they are read again from its scan every time they are iterated,
+        from its csv if it is neither loaded nor stored
+        With positions, every record ends with its position in the records
+        len is the estimated number of records of the table before filtering
+    """
+
+    def __init__(self, table_name, conditions, indices, semi_joins, estimated_bytes):
+        self.table_name = table_name
+        self.conditions = conditions
+        self.indices = indices
+        self.semi_joins = semi_joins
+        self.estimated_bytes = estimated_bytes
+        self.positions = False
+        self.length = estimated_table_length(table_name)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        records = chain.from_iterable(filtered_record_batches(self.table_name, \
+            self.conditions, self.indices, self.semi_joins, stream=True))
+        if self.positions:
+            return (record + (i,) for i, record in enumerate(records))
+        return records
+
+def semi_join_filters(table_name, join_conditions, records_dict, column_names_dict):
+    """
+        Returns (column_name, index, keys) for every equality join condition between
+        table_name and a table held in records_dict with fewer records, where keys is
+        the frozenset of the keys of the other table and index is the position of
+        column_name in the records of table_name
+        Tables read from their scan are skipped, their keys may not fit in memory
+    """
+    semi_joins = []
+    if not SEMI_JOIN_FILTERS:
+        return semi_joins
+    for condition in join_conditions:
+        if str(condition[1]) != "=":
+            continue
+        left, right = str(condition[0]), str(condition[2])
+        if right.split(".")[0] == table_name:
+            left, right = right, left
+        other_table_name = right.split(".")[0]
+        if left.split(".")[0] != table_name or other_table_name not in records_dict \
+            or isinstance(records_dict[other_table_name], ScannedRecords) \
+            or len(records_dict[other_table_name]) >= estimated_table_length(table_name):
+            continue
+        other_index = column_names_dict[other_table_name].index(right)
+        keys = frozenset([cell_value(record[other_index]) \
+            for record in records_dict[other_table_name]])
+        semi_joins.append((left, COLUMNS_DICT[table_name].index(left.split(".")[1]), keys))
+    return semi_joins
+
+def plan_index_join(table_name, join_conditions, records_dict, column_names_dict):
+    """
+        Returns (column_name, column_index) of an equality join condition between
+        table_name and the tables of records_dict, where column_name is the column
+        of the other table and column_index the index of the column of table_name,
+        if the join of the tables of records_dict is estimated to be small enough
+        to probe the index of table_name with every record of it
+        Returns None otherwise
+    """
+    other_conditions = [condition for condition in join_conditions \
+        if str(condition[0]).split(".")[0] in records_dict \
+        and str(condition[2]).split(".")[0] in records_dict]
+    cardinalities = {}
+    for other_table_name, records in records_dict.items():
+        cardinalities[other_table_name] = len(records)
+    outer_size = estimate_join_size(frozenset(records_dict), cardinalities, \
+        join_selectivities(other_conditions, records_dict, column_names_dict))
+    if outer_size > INDEX_JOIN_MAX_OUTER \
+        or outer_size * INDEX_JOIN_RATIO > estimated_table_length(table_name):
+        return None
+
+    for condition in join_conditions:
+        if str(condition[1]) != "=":
+            continue
+        left, right = str(condition[0]), str(condition[2])
+        if right.split(".")[0] == table_name:
+            left, right = right, left
+        if left.split(".")[0] == table_name and right.split(".")[0] in records_dict:
+            debug("join %s: estimated %d outer records, index nested loop join on %s" % \
+                (table_name, outer_size, left))
+            return right, COLUMNS_DICT[table_name].index(left.split(".")[1])
+    return None
+
+def index_join(all_records, table_name, all_index, column_index, conditions=None, \
+    indices=None, with_positions=False):
+    """
+        Index nested loop join of the records joined so far with table_name
+        The index of the column at column_index of table_name is probed with the
+        value at all_index of every record, the records at the positions found are
+        fetched from the columns and filtered with conditions
+        With indices, only the columns at those indices of the fetched records are kept
+        With with_positions, the position of every fetched record is appended to it
+        Records come out in the same order as in the cross product
+    """
+    columns = load_table(table_name)
+    index = get_column_index(table_name, column_index)
+    predicate = None
+    if conditions:
+        column_names_dict = {}
+        for i, column_name in enumerate(qualified_column_names([table_name])):
+            column_names_dict[column_name] = i
+        predicate = compile_conditions(conditions, column_names_dict)
+
+    fetched = {}
+    for record in all_records:
+        key = cell_value(record[all_index])
+        if key not in fetched:
+            positions = index.get(key, [])
+            matches = [tuple([column[position] for column in columns]) \
+                for position in positions]
+            if predicate is not None and matches:
+                flags = [predicate(match) for match in matches]
+                positions = [position for position, flag in izip(positions, flags) if flag]
+                matches = [match for match, flag in izip(matches, flags) if flag]
+            if indices is not None:
+                matches = [tuple([match[i] for i in indices]) for match in matches]
+            if with_positions:
+                matches = [match + (position,) for match, position in izip(matches, positions)]
+            fetched[key] = matches
+        for present_table_record in fetched[key]:
+            yield record + present_table_record
+
+def join_selectivities(join_conditions, records_dict, column_names_dict):
+    """
+        Returns [(tables, selectivity)] for every join condition, where tables is the
+        frozenset of the two tables it compares
+        An equality keeps 1 / (number of distinct values of the bigger side) of the
+        combinations, a range condition keeps RANGE_JOIN_SELECTIVITY of them
+    """
+    selectivities = []
+    for condition in join_conditions:
+        left, operator, right = str(condition[0]), str(condition[1]), str(condition[2])
+        tables = frozenset([left.split(".")[0], right.split(".")[0]])
+        if str(operator) != "=":
+            selectivities.append((tables, RANGE_JOIN_SELECTIVITY))
+            continue
+        distinct_values = 1
+        for column_name in (left, right):
+            table_name = column_name.split(".")[0]
+            index = column_names_dict[table_name].index(column_name)
+            distinct_values = max(distinct_values, \
+                len(set([cell_value(record[index]) for record in records_dict[table_name]])))
+        selectivities.append((tables, 1.0 / distinct_values))
+    return selectivities
+
+def estimate_join_size(tables, cardinalities, selectivities):
+    """
+        Returns the estimated number of records of the join of the set of tables
+    """
+    size = 1.0
+    for table_name in tables:
+        size *= cardinalities[table_name]
+    for condition_tables, selectivity in selectivities:
+        if condition_tables <= tables:
+            size *= selectivity
+    return size
+
+def join_order_cost(order, cardinalities, selectivities):
+    """
+        Returns the estimated number of intermediate records of joining the tables in order
+    """
+    cost = 0.0
+    for i in xrange(2, len(order) + 1):
+        cost += estimate_join_size(frozenset(order[:i]), cardinalities, selectivities)
+    return cost
+
+def choose_join_order(table_names, cardinalities, selectivities):
+    """
+        Returns the order of table_names that minimizes the estimated number of
+        intermediate records, keeping the written order unless another one is cheaper
+        by more than the joined records, which are all held in memory to be sorted
+        back into the written order
+        1. at most JOIN_DP_MAX_TABLES tables -- dynamic programming, the best order of
+                                               every subset extends the best order of
+                                               one of its subsets by one table
+        2. more tables                       -- greedy, start with the smallest table and
+                                               add the one giving the smallest join
+    """
+    if len(table_names) <= JOIN_DP_MAX_TABLES:
+        method = "dynamic programming"
+        best = {}
+        for table_name in table_names:
+            best[frozenset([table_name])] = (0.0, [table_name])
+        for number_of_tables in xrange(2, len(table_names) + 1):
+            for subset in combinations(table_names, number_of_tables):
+                tables = frozenset(subset)
+                size = estimate_join_size(tables, cardinalities, selectivities)
+                for table_name in subset:
+                    cost, order = best[tables - frozenset([table_name])]
+                    if tables not in best or cost + size < best[tables][0]:
+                        best[tables] = (cost + size, order + [table_name])
+        order = best[frozenset(table_names)][1]
+    else:
+        method = "greedy"
+        order = [min(table_names, key=lambda table_name: cardinalities[table_name])]
+        while len(order) < len(table_names):
+            order.append(min([table_name for table_name in table_names \
+                if table_name not in order], key=lambda table_name: \
+                estimate_join_size(frozenset(order + [table_name]), cardinalities, selectivities)))
+
+    cost = join_order_cost(order, cardinalities, selectivities)
+    written_cost = join_order_cost(table_names, cardinalities, selectivities)
+    sort_cost = estimate_join_size(frozenset(table_names), cardinalities, selectivities)
+    if cost + sort_cost >= written_cost:
+        order, cost = list(table_names), written_cost
+    debug("join order: %s (%s, estimated %d intermediate records, %d as written, " \
+        "%d to sort back)" % (", ".join(order), method, cost, written_cost, sort_cost))
+    return order
+
+def execute_joins(table_names, join_conditions, table_conditions=None, needed_columns=None):
+    """
+        Joins the tables in the order chosen by choose_join_order
+        Every table is joined on the join_conditions connecting it to the tables before it
+        1. equality conditions -- merge join if both inputs are sorted on the key,
+                                  hash join otherwise
+        2. range conditions    -- sort-merge join
+        3. no conditions       -- cross product
+        table_conditions[table_name] filter the records of table_name before the join
+        With needed_columns, the other columns are dropped from the records of
+        every table before the join
+        The biggest table is read last, dropping the records that the keys
+        of the smaller tables it is equi-joined with can't match, or it is not read
+        at all but joined by probing its column index if the others join to few records
+        Returns the joined records, with the columns and in the order of the cross product
+        of table_names, and their column names
+        In the written order the records come from a pipeline of generators and only
+        the tables themselves are held in memory, in any other order the joined records
+        are sorted back by the positions of their records in the tables
+    """
+    table_conditions = table_conditions or {}
+    records_dict = {}
+    column_names_dict = {}
+    # The biggest table is read last, through the semi-join filters of the others
+    fact_table_name = None
+    if join_conditions and len(set(table_names)) == len(table_names):
+        fact_table_name = max(table_names, key=estimated_table_length)
+    for table_name in sorted(table_names, key=lambda table_name: table_name == fact_table_name):
+        present_column_names = qualified_column_names([table_name])
+        indices = None
+        if needed_columns is not None:
+            indices = [i for i, column_name in enumerate(present_column_names) \
+                if column_name in needed_columns]
+            if len(indices) == len(present_column_names):
+                indices = None
+            else:
+                present_column_names = [present_column_names[i] for i in indices]
+                debug("join %s: carrying %d column(s)" % (table_name, len(indices)))
+        column_names_dict[table_name] = present_column_names
+        semi_joins = None
+        if table_name == fact_table_name:
+            index_join_key = plan_index_join(table_name, join_conditions, \
+                records_dict, column_names_dict)
+            if index_join_key is not None:
+                index_join_indices = indices
+                continue
+            semi_joins = semi_join_filters(table_name, join_conditions, \
+                records_dict, column_names_dict)
+        estimated_bytes = table_records_bytes(table_name, indices) if join_conditions else 0
+        if estimated_bytes > HASH_JOIN_MEMORY:
+            debug("join %s: ~%d bytes of records, read from its scan when joined" % \
+                (table_name, estimated_bytes))
+            records_dict[table_name] = ScannedRecords(table_name, \
+                table_conditions.get(table_name), indices, semi_joins, estimated_bytes)
+        else:
+            records_dict[table_name] = filtered_table_records(table_name, \
+                table_conditions.get(table_name), indices, semi_joins)
+
+    # The tables read into memory, in the written order
+    read_table_names = [table_name for table_name in table_names if table_name in records_dict]
+    order = list(read_table_names)
+    # The conditions between them, a table joined by its index isn't read
+    read_join_conditions = [condition for condition in join_conditions \
+        if str(condition[0]).split(".")[0] in records_dict \
+        and str(condition[2]).split(".")[0] in records_dict]
+    # Cross products keep the written order, which streams their records
+    if len(read_table_names) > 2 and read_join_conditions \
+        and len(set(table_names)) == len(table_names):
+        cardinalities = {}
+        for table_name in read_table_names:
+            cardinalities[table_name] = len(records_dict[table_name])
+        order = choose_join_order(read_table_names, cardinalities, \
+            join_selectivities(read_join_conditions, records_dict, column_names_dict))
+    if len(read_table_names) < len(table_names):
+        order.append(fact_table_name)
+    reordered = order != list(table_names)
+    if reordered:
+        # Remember the position of every record in its table to restore the order
+        for table_name in table_names:
+            if isinstance(records_dict.get(table_name), ScannedRecords):
+                records_dict[table_name].positions = True
+            elif table_name in records_dict:
+                records_dict[table_name] = [record + (i,) \
+                    for i, record in enumerate(records_dict[table_name])]
+            column_names_dict[table_name] = column_names_dict[table_name] + \
+                [table_name + ROW_POSITION_COLUMN]
+
+    joined_column_names = []
+    all_records = None
+    for table_name in order:
+        present_column_names = column_names_dict[table_name]
+        if table_name not in records_dict:
+            outer_column_name, column_index = index_join_key
+            all_records = index_join(all_records, table_name, \
+                joined_column_names.index(outer_column_name), column_index, \
+                table_conditions.get(table_name), index_join_indices, reordered)
+            joined_column_names += present_column_names
+            continue
+
+        present_table_records = records_dict[table_name]
+        if all_records is None:
+            all_records = present_table_records
+            joined_column_names += present_column_names
+            continue
+
+        key_indices = []
+        range_keys = []
+        for condition in join_conditions:
+            left, operator, right = str(condition[0]), str(condition[1]), str(condition[2])
+            if right in present_column_names and left in joined_column_names:
+                key = (joined_column_names.index(left), present_column_names.index(right))
+            elif left in present_column_names and right in joined_column_names:
+                key = (joined_column_names.index(right), present_column_names.index(left))
+                operator = FLIPPED_OPERATORS[operator]
+            else:
+                continue
+            if operator == "=":
+                key_indices.append(key)
+            else:
+                range_keys.append((key, operator))
+
+        if isinstance(present_table_records, ScannedRecords) and not key_indices:
+            # joined without a hash table, the records are held in memory
+            present_table_records = list(present_table_records)
+
+        if len(key_indices) == 1 and isinstance(all_records, list) \
+            and isinstance(present_table_records, list) and present_table_records \
+            and is_sorted([cell_value(record[key_indices[0][0]]) for record in all_records]) \
+            and is_sorted([cell_value(record[key_indices[0][1]]) \
+                for record in present_table_records]):
+            debug("join %s: merge join on sorted inputs" % table_name)
+            all_records = merge_join(all_records, present_table_records, \
+                key_indices[0][0], key_indices[0][1], "=")
+        elif key_indices:
+            debug("join %s: hash join on %d key(s)" % (table_name, len(key_indices)))
+            all_records = hash_join(all_records, present_table_records, key_indices)
+        elif range_keys:
+            (all_index, present_index), operator = range_keys[0]
+            debug("join %s: sort-merge join on %s" % (table_name, operator))
+            all_records = merge_join(all_records, present_table_records, \
+                all_index, present_index, operator)
+        else:
+            debug("join %s: cross product" % table_name)
+            all_records = join_util(all_records, present_table_records)
+        joined_column_names += present_column_names
+
+    if not reordered:
+        return all_records, joined_column_names
+
+    position_indices = [joined_column_names.index(table_name + ROW_POSITION_COLUMN) \
+        for table_name in table_names]
+    column_names = []
     for table_name in table_names:
-        present_table_column_names = copy.deepcopy(COLUMNS_DICT[table_name])
-        for i, column_name in enumerate(present_table_column_names):
-            present_table_column_names[i] = table_name + "." + column_name
-        modified_column_names += present_table_column_names
+        column_names += column_names_dict[table_name][:-1]
+    column_indices = [joined_column_names.index(column_name) for column_name in column_names]
+    all_records = sorted(all_records, key=itemgetter(*position_indices))
+    return (tuple([record[i] for i in column_indices]) for record in all_records), column_names
 
-    return all_records, modified_column_names
+# Name of the column holding the position of a record in its table, after the table name
+ROW_POSITION_COLUMN = ".#"
+
+def qualified_column_names(table_names):
+    """
+        Returns the columns of all the tables in table_names as table_name.column_name
+    """
+    modified_column_names = []
+    for table_name in table_names:
+        modified_column_names += [table_name + "." + column_name \
+            for column_name in COLUMNS_DICT[table_name]]
+    return modified_column_names
 
 def is_int(element):
     """
@@ -408,6 +2905,46 @@ def is_int(element):
     except:
         return False
 
+# Operators comparing a column with a list of constants, in conditions written as
+# [column, operator, "[value,value,...]"]
+#   IN, NOT IN -- the value of the column is (not) one of the constants
+#   BETWEEN    -- the value of the column is in [first constant, second constant]
+LIST_OPERATORS = ("IN", "NOT IN", "BETWEEN")
+
+IN_PREDICATE = re.compile(r"(\S+)\s+(NOT\s+)?IN\s*\(([^()]*)\)", re.IGNORECASE)
+BETWEEN_PREDICATE = re.compile(r"(\S+)\s+BETWEEN\s+([^\s()]+)\s+AND\s+([^\s()]+)", \
+    re.IGNORECASE)
+
+def rewrite_list_predicates(conditional_statement):
+    """
+        Rewrite the IN, NOT IN and BETWEEN predicates so that each is split as
+        one condition, with NOT_IN standing for NOT IN
+        'where A in (1, 2) and B between 3 and 5'
+            ---> 'where A IN [1,2] and B BETWEEN [3,5]'
+    """
+    conditional_statement = IN_PREDICATE.sub(lambda match: "%s %s [%s]" % \
+        (match.group(1), "NOT_IN" if match.group(2) else "IN", \
+        "".join(match.group(3).split())), conditional_statement)
+    return BETWEEN_PREDICATE.sub(lambda match: "%s BETWEEN [%s,%s]" % match.groups(), \
+        conditional_statement)
+
+def condition_values(condition):
+    """
+        Returns the constants of a condition with one of the LIST_OPERATORS as ints
+        Raises ValueError if one of them is not an int
+    """
+    values = [int(value) for value in str(condition[2])[1:-1].split(",")]
+    if str(condition[1]) == "BETWEEN" and len(values) != 2:
+        raise ValueError("BETWEEN takes two values")
+    return values
+
+def compares_columns(condition):
+    """
+        returns True if condition compares its column with another column
+        returns False if it compares it with constants
+    """
+    return str(condition[1]) not in LIST_OPERATORS and not is_int(condition[2])
+
 def split_conditional_statement(conditional_statement):
     """
         Split with delimiters as "=", ">", "<", ">=", "<="
@@ -462,7 +2999,8 @@ def get_conditions(conditional_statement, query_tables):
         Return all the conditions in the form of list
         [["A", "=", "4"], "AND", ["B", "=", "5"]]
     """
-    conditional_statement = split_conditional_statement(conditional_statement)
+    conditional_statement = split_conditional_statement( \
+        rewrite_list_predicates(conditional_statement))
 
     conditions = []
     condition = []
@@ -505,6 +3043,10 @@ def get_conditions(conditional_statement, query_tables):
         if counter == 3:
             conditions.append(condition)
 
+        for condition in conditions:
+            if isinstance(condition, list) and len(condition) > 1 and condition[1] == "NOT_IN":
+                condition[1] = "NOT IN"
+
         modified_conditions = []
 
         col_ambiguous_errors = 0
@@ -520,7 +3062,7 @@ def get_conditions(conditional_statement, query_tables):
                         if count > 1:
                             print "column " + condition[0] + " is ambiguous"
                             col_ambiguous_errors += 1
-                if not is_int(condition[2]):
+                if compares_columns(condition):
                     if not isinstance(condition[0], list):
                         count = 0
                         for table in query_tables:
@@ -544,7 +3086,7 @@ def get_conditions(conditional_statement, query_tables):
                             new_condition = []
                             new_condition.append(table + "." + condition[0])
                             new_condition.append(condition[1])
-                            if is_int(condition[2]):
+                            if not compares_columns(condition):
                                 new_condition.append(condition[2])
                             else:
                                 for temp_table in query_tables:
@@ -557,7 +3099,114 @@ def get_conditions(conditional_statement, query_tables):
                     modified_conditions.append(condition)
             else:
                 modified_conditions.append(condition)
-        return modified_conditions
+        return rewrite_or_chains(modified_conditions)
+
+def parse_condition_tree(conditions):
+    """
+        Returns the conditions as a tree following AND/OR precedence and parentheses
+        [["A", "=", "4"], "AND", ["B", "=", "5"], "OR", ["C", "=", "6"]]
+            ---> ("OR", [("AND", [["A", "=", "4"], ["B", "=", "5"]]), ["C", "=", "6"]])
+    """
+    position = [0]
+
+    def parse_or():
+        children = [parse_and()]
+        while position[0] < len(conditions) and conditions[position[0]] == "OR":
+            position[0] += 1
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ("OR", children)
+
+    def parse_and():
+        children = [parse_factor()]
+        while position[0] < len(conditions) and conditions[position[0]] == "AND":
+            position[0] += 1
+            children.append(parse_factor())
+        return children[0] if len(children) == 1 else ("AND", children)
+
+    def parse_factor():
+        element = conditions[position[0]]
+        position[0] += 1
+        if element == "(":
+            tree = parse_or()
+            position[0] += 1
+            return tree
+        return element
+
+    return parse_or()
+
+def flatten_condition_tree(condition_tree):
+    """
+        Inverse of parse_condition_tree, returns the conditions as a list
+        ("AND", [["A", "=", "4"], ("OR", [["B", "=", "5"], ["C", "=", "6"]])])
+            ---> [["A", "=", "4"], "AND", "(", ["B", "=", "5"], "OR", ["C", "=", "6"], ")"]
+    """
+    if not isinstance(condition_tree, tuple):
+        return [condition_tree]
+    operator, children = condition_tree
+    conditions = []
+    for child in children:
+        if conditions:
+            conditions.append(operator)
+        if isinstance(child, tuple):
+            conditions += ["("] + flatten_condition_tree(child) + [")"]
+        else:
+            conditions.append(child)
+    return conditions
+
+def merge_or_chains(condition_tree):
+    """
+        Returns condition_tree with the equalities of a column with constants under
+        an OR node merged into one IN condition where there are at least
+        OR_CHAIN_MIN_LENGTH of them
+        ("OR", [["A", "=", "1"], ["B", "=", "2"], ["A", "=", "3"], ["A", "=", "4"]])
+            ---> ("OR", [["A", "IN", "[1,3,4]"], ["B", "=", "2"]])
+    """
+    if not isinstance(condition_tree, tuple):
+        return condition_tree
+    operator, children = condition_tree
+    children = [merge_or_chains(child) for child in children]
+    if operator != "OR":
+        return (operator, children)
+
+    chains = {}
+    for child in children:
+        if not isinstance(child, tuple) and len(child) == 3 and str(child[1]) == "=" \
+            and is_int(child[2]) and not is_int(child[0]):
+            chains.setdefault(str(child[0]), []).append(child)
+
+    merged_children = []
+    for child in children:
+        if not isinstance(child, tuple) and str(child[0]) in chains \
+            and len(chains[str(child[0])]) >= OR_CHAIN_MIN_LENGTH:
+            equalities = chains[str(child[0])]
+            if child is equalities[0]:
+                merged_children.append([child[0], "IN", \
+                    "[" + ",".join([str(condition[2]) for condition in equalities]) + "]"])
+            elif any([child is condition for condition in equalities]):
+                continue
+            else:
+                merged_children.append(child)
+        else:
+            merged_children.append(child)
+    if len(merged_children) == 1:
+        return merged_children[0]
+    return (operator, merged_children)
+
+def rewrite_or_chains(conditions):
+    """
+        Returns conditions with their OR-chains of equalities merged by merge_or_chains
+        Returns conditions unchanged if there is nothing to merge
+    """
+    if not OR_CHAIN_MIN_LENGTH or "OR" not in conditions:
+        return conditions
+    condition_tree = parse_condition_tree(conditions)
+    merged_tree = merge_or_chains(condition_tree)
+    if merged_tree == condition_tree:
+        return conditions
+    debug("merged OR-chains: " + " ".join([" ".join(condition) \
+        if isinstance(condition, list) else condition \
+        for condition in flatten_condition_tree(merged_tree)]))
+    return flatten_condition_tree(merged_tree)
 
 def hide_query_columns(conditions, query_columns):
     """
@@ -595,56 +3244,168 @@ def hide_query_columns(conditions, query_columns):
     # return query_columns_to_hide
     return []
 
-def set_record_flags(all_records, conditions, modified_column_names_dict):
+# Comparison of the values of a condition for every operator
+COMPARISONS = {"=": eq, ">": gt, ">=": ge, "<": lt, "<=": le}
+
+def compile_condition(condition, modified_column_names_dict):
     """
-        if all_records_flags[i] == True, all_records[i] should be shown
+        Returns a function of a record which is True if the record satisfies condition
+        The indices of the columns and the constant are resolved here, once
     """
-    all_records_flags = []
+    index = modified_column_names_dict[str(condition[0])]
+    operator = str(condition[1])
+    if operator in LIST_OPERATORS:
+        values = condition_values(condition)
+        if operator == "BETWEEN":
+            low, high = values
+            return lambda record: low <= cell_value(record[index]) <= high
+        values = frozenset(values)
+        if operator == "IN":
+            return lambda record: cell_value(record[index]) in values
+        return lambda record: cell_value(record[index]) not in values
+
+    other_index = None
+    value = 0
+    if len(condition[2].split(".")) > 1:
+        other_index = modified_column_names_dict[str(condition[2])]
+    else:
+        value = int(condition[2])
+
+    compare = COMPARISONS.get(str(condition[1]))
+    if compare is None:
+        return lambda record: False
+    if other_index is None:
+        return lambda record: compare(cell_value(record[index]), value)
+    return lambda record: compare(cell_value(record[index]), cell_value(record[other_index]))
+
+def compile_condition_tree(condition_tree, modified_column_names_dict):
+    """
+        Returns a function of a record which is True if the record satisfies
+        condition_tree, the functions of the children of AND/OR nodes are nested
+    """
+    if not isinstance(condition_tree, tuple):
+        return compile_condition(condition_tree, modified_column_names_dict)
+
+    operator, children = condition_tree
+    children = [compile_condition_tree(child, modified_column_names_dict) for child in children]
+    if operator == "AND":
+        def and_predicate(record):
+            for child in children:
+                if not child(record):
+                    return False
+            return True
+        return and_predicate
+
+    def or_predicate(record):
+        for child in children:
+            if child(record):
+                return True
+        return False
+    return or_predicate
 
-    for i, record in enumerate(all_records):
-        all_records_flags.append(False)
-        evaluation_string = ""
-        ops = []
-        for j, condition in enumerate(conditions):
-            current = False
-            if isinstance(condition, list):
-                index = modified_column_names_dict[str(condition[0])]
-                val1 = int(record[index])
-                val2 = 0
-                if len(condition[2].split(".")) > 1:
-                    other_index = modified_column_names_dict[str(condition[2])]
-                    val2 = int(record[other_index])
-                else:
-                    val2 = int(condition[2])
-                if str(condition[1]) == "=":
-                    current = (val1 == val2)
-                elif str(condition[1]) == ">":
-                    current = (val1 > val2)
-                elif str(condition[1]) == ">=":
-                    current = (val1 >= val2)
-                elif str(condition[1]) == "<":
-                    current = (val1 < val2)
-                elif str(condition[1]) == "<=":
-                    current = (val1 <= val2)
-                evaluation_string += str(current)
-            else:
-                ops.append(condition)
-                if condition == "AND":
-                    evaluation_string += " and "
-                elif condition == "OR":
-                    evaluation_string += " or "
-                elif condition == "(":
-                    evaluation_string += "("
-                elif condition == ")":
-                    evaluation_string += ")"
-        all_records_flags[i] = eval(evaluation_string)
-
-    return all_records_flags
-
-def project_output(query_columns, all_records, \
-    modified_column_names, is_distinct, all_records_flags, query_columns_to_hide):
+def condition_cost(condition_tree):
+    """
+        Returns the estimated cost of evaluating condition_tree on a record, the
+        number of column values it reads
+    """
+    if isinstance(condition_tree, tuple):
+        return sum([condition_cost(child) for child in condition_tree[1]])
+    if str(condition_tree[1]) in LIST_OPERATORS:
+        return 1
+    return 2 if len(condition_tree[2].split(".")) > 1 else 1
+
+def reorder_condition_tree(condition_tree, sample, modified_column_names_dict):
+    """
+        Returns condition_tree with the children of every AND/OR node ordered by
+        cost / (1 - pass rate) for AND and cost / pass rate for OR, the pass rates
+        being measured on the records of sample
+        Children of equal rank keep their order
+    """
+    if not isinstance(condition_tree, tuple) or not sample:
+        return condition_tree
+
+    operator, children = condition_tree
+    ranked_children = []
+    for position, child in enumerate(children):
+        child = reorder_condition_tree(child, sample, modified_column_names_dict)
+        predicate = compile_condition_tree(child, modified_column_names_dict)
+        passed = len([record for record in sample if predicate(record)])
+        pass_rate = (passed + 1.0) / (len(sample) + 2)
+        if operator == "AND":
+            rank = condition_cost(child) / (1 - pass_rate)
+        else:
+            rank = condition_cost(child) / pass_rate
+        ranked_children.append((rank, position, child))
+    ranked_children.sort()
+    return (operator, [child for _, _, child in ranked_children])
+
+def compile_conditions(conditions, modified_column_names_dict):
+    """
+        Returns a function of a record which is True if the record satisfies conditions
+        AND binds tighter than OR and parentheses group conditions
+        If conditions can't be compiled, e.g. they use an unknown column, the function
+        raises the error when it is called, like evaluating the first record would
+    """
+    try:
+        return compile_condition_tree(parse_condition_tree(conditions), \
+            modified_column_names_dict)
+    except Exception as e:
+        error = e
+        def failing_predicate(record):
+            raise error
+        return failing_predicate
+
+def select_records(query_tables, conditions=None, table_conditions=None, query_columns=None):
+    """
+        Returns the batches of records of the scan or the join of query_tables
+        and their column names
+        table_conditions[table_name] are applied to the records of table_name
+        conditions are used to choose join methods, they still have to be applied
+        to the records
+        With query_columns, joins only carry the columns needed by the query
+    """
+    table_conditions = table_conditions or {}
+    if len(query_tables) == 1:
+        table_name = query_tables[0]
+        modified_column_names = qualified_column_names([table_name])
+        record_batches = scan_table(table_name, conditions=table_conditions.get(table_name))
+        if not table_conditions.get(table_name):
+            return record_batches, modified_column_names
+        column_names_dict = {}
+        for i, column_name in enumerate(modified_column_names):
+            column_names_dict[column_name] = i
+        record_batches = filter_records(record_batches, \
+            table_conditions[table_name], column_names_dict)
+        return record_batches, modified_column_names
+    return join_tables(query_tables, conditions, table_conditions, query_columns)
+
+def filter_records(record_batches, conditions, modified_column_names_dict):
+    """
+        Yields the records of every batch in record_batches that satisfy conditions
+        AND/OR conditions are reordered for every batch by reorder_condition_tree
+    """
+    predicate = compile_conditions(conditions, modified_column_names_dict)
+    try:
+        condition_tree = parse_condition_tree(conditions)
+        compile_condition_tree(condition_tree, modified_column_names_dict)
+    except Exception:
+        # predicate raises the error on the first record
+        condition_tree = None
+
+    for records in record_batches:
+        if isinstance(condition_tree, tuple) and PREDICATE_SAMPLE_SIZE and records:
+            reordered_tree = reorder_condition_tree(condition_tree, \
+                records[:PREDICATE_SAMPLE_SIZE], modified_column_names_dict)
+            if reordered_tree != condition_tree:
+                condition_tree = reordered_tree
+                predicate = compile_condition_tree(condition_tree, modified_column_names_dict)
+        yield [record for record in records if predicate(record)]
+
+def project_output(query_columns, record_batches, \
+    modified_column_names, is_distinct, query_columns_to_hide):
     """
         Show Final Output after join when there are conditions
+        Records are printed batch by batch as record_batches produces them
     """
 
     for hidden_col in query_columns_to_hide:
@@ -658,6 +3419,11 @@ def project_output(query_columns, all_records, \
         if col in query_columns:
             query_columns_indices.append(i)
 
+    # Produce the first batch before printing anything so that a failing
+    # query prints only its error
+    record_batches = iter(record_batches)
+    first_batch = next(record_batches, [])
+
     meta_data_output = ""
     for i, query_columns_index in enumerate(query_columns_indices):
         if i == len(query_columns_indices) - 1:
@@ -666,25 +3432,398 @@ def project_output(query_columns, all_records, \
         else:
             meta_data_output += str(modified_column_names[query_columns_index]) + ","
 
-    output_records = []
-    for j, record in enumerate(all_records):
-        if all_records_flags[j] is True:
-            output = ""
-            for i, query_columns_index in enumerate(query_columns_indices):
-                if i == len(query_columns_indices) - 1:
-                    output += str(record[query_columns_index])
-                else:
-                    output += str(record[query_columns_index]) + ","
+    output_records = set()
+    for records in chain([first_batch], record_batches):
+        for record in records:
+            output = ",".join([str(record[query_columns_index]) \
+                for query_columns_index in query_columns_indices])
             if is_distinct:
-                if output not in output_records:
-                    output_records.append(output)
+                if output in output_records:
+                    continue
+                output_records.add(output)
+            print output
+
+# ------------Compiled Query Plans----------
+# Source of the comparison of the values of a condition for every operator
+COMPARISON_SOURCES = {"=": "==", ">": ">", ">=": ">=", "<": "<", "<=": "<="}
+
+def constant_source(value, parameters):
+    """
+        Returns the python expression of a constant of a condition
+        The placeholder ?<i> of a cached plan is named parameter_<i>, which is
+        appended to parameters
+    """
+    value = str(value).strip()
+    if value.startswith("?"):
+        parameters.append("parameter_%d" % int(value[1:]))
+        return parameters[-1]
+    return repr(int(value))
+
+def condition_source(condition_tree, modified_column_names_dict, value_sets, parameters):
+    """
+        Returns the python expression of condition_tree on a record
+        The constants of IN and NOT IN conditions are appended to value_sets and
+        named value_set_<position in value_sets> in the expression, the placeholders
+        are appended to parameters by constant_source
+        Raises KeyError or ValueError if it uses an unknown column or a bad constant
+    """
+    if isinstance(condition_tree, tuple):
+        operator, children = condition_tree
+        return "(" + (" and " if operator == "AND" else " or ").join( \
+            [condition_source(child, modified_column_names_dict, value_sets, parameters) \
+            for child in children]) + ")"
+
+    condition = condition_tree
+    left = "cell_value(record[%d])" % modified_column_names_dict[str(condition[0])]
+    if str(condition[1]) in LIST_OPERATORS:
+        values = [constant_source(value, parameters) \
+            for value in str(condition[2])[1:-1].split(",")]
+        if str(condition[1]) == "BETWEEN":
+            if len(values) != 2:
+                raise ValueError("BETWEEN takes two values")
+            return "(%s <= %s <= %s)" % (values[0], left, values[1])
+        value_sets.append(values)
+        return "(%s %s value_set_%d)" % (left, str(condition[1]).lower(), len(value_sets) - 1)
+    if len(condition[2].split(".")) > 1:
+        right = "cell_value(record[%d])" % modified_column_names_dict[str(condition[2])]
+    else:
+        right = constant_source(condition[2], parameters)
+    if str(condition[1]) not in COMPARISON_SOURCES:
+        return "False"
+    return "(%s %s %s)" % (left, COMPARISON_SOURCES[str(condition[1])], right)
+
+def compile_query_code(modified_column_names, conditions, output_columns, is_distinct):
+    """
+        Returns the code object of process_records(records, output_records), a loop
+        filtering records with conditions and returning the lines of the output
+        columns of the records, leaving out lines already in output_records if
+        is_distinct, with the column offsets and constants written into it
+        The placeholders of the conditions of a cached plan are read from the
+        parameter_<i> globals when the code is run
+    """
+    modified_column_names_dict = {}
+    for i, column_name in enumerate(modified_column_names):
+        modified_column_names_dict[column_name] = i
+    output_indices = [i for i, column_name in enumerate(modified_column_names) \
+        if column_name in output_columns]
+
+    source = ["def process_records(records, output_records):",
+              "    lines = []",
+              "    for record in records:"]
+    if conditions:
+        value_sets = []
+        parameters = []
+        source.append("        if not %s:" % condition_source(parse_condition_tree( \
+            conditions), modified_column_names_dict, value_sets, parameters))
+        source.append("            continue")
+        # the sets and parameters are bound once, as default values of the
+        # parameters of process_records
+        source[0] = "def process_records(records, output_records%s%s):" % ( \
+            "".join([", %s=%s" % (name, name) for name in sorted(set(parameters))]), \
+            "".join([", value_set_%d=frozenset([%s])" % (i, ", ".join(values)) \
+            for i, values in enumerate(value_sets)]))
+    if output_indices:
+        source.append("        line = %r %% (%s,)" % (",".join(["%s"] * len(output_indices)), \
+            ", ".join(["record[%d]" % i for i in output_indices])))
+    else:
+        source.append("        line = ''")
+    if is_distinct:
+        source.append("        if line in output_records:")
+        source.append("            continue")
+        source.append("        output_records.add(line)")
+    source.append("        lines.append(line)")
+    source.append("    return lines")
+    debug("compiled query:\n" + "\n".join(source))
+    return compile("\n".join(source) + "\n", "<query>", "exec")
+
+def plan_query(query_tables, query_columns, conditions, query_columns_to_hide, is_distinct):
+    """
+        Returns the plan of a SELECT query after its tables, columns and conditions
+        are checked, a dict of marshallable values holding
+        tables, table_conditions -- what select_records needs
+        conditions               -- the conditions left to filter the selected records
+        query_columns            -- the columns joins carry
+        output_columns           -- the columns printed, without the hidden ones
+        column_names, code       -- the columns of the selected records and the
+                                    code compiled for them by compile_query_code
+        Raises KeyError or ValueError if the conditions can't be compiled
+    """
+    output_columns = list(query_columns)
+    for hidden_col in query_columns_to_hide:
+        if hidden_col in output_columns:
+            output_columns.remove(hidden_col)
+
+    if len(query_tables) == 1:
+        # The scan uses all the conditions to skip blocks
+        table_conditions = {}
+        modified_column_names = qualified_column_names(query_tables)
+    else:
+        table_conditions, conditions = push_down_conditions(conditions, query_tables)
+        needed_columns = set(query_columns) | condition_columns(conditions)
+        modified_column_names = [column_name for column_name in \
+            qualified_column_names(query_tables) if column_name in needed_columns]
+
+    return {"tables": list(query_tables), "table_conditions": table_conditions, \
+        "conditions": conditions, "query_columns": list(query_columns), \
+        "output_columns": output_columns, "distinct": is_distinct, \
+        "column_names": modified_column_names, "code": compile_query_code( \
+        modified_column_names, conditions, output_columns, is_distinct)}
+
+def execute_query_plan(plan):
+    """
+        Select the records of the plan and print the output lines of process_records
+        Single table queries are filtered by vectorized_scan when possible
+        The code is compiled again if the plan has none or the selected records are
+        already filtered, the code of a cached plan reads its constants from
+        plan["parameters"]
+        Returns False without printing anything if the selected records have other
+        columns than the plan was made for, True otherwise
+    """
+    query_tables = plan["tables"]
+    conditions = plan["conditions"]
+    if len(query_tables) == 1:
+        modified_column_names = qualified_column_names(query_tables)
+        record_batches = vectorized_scan(query_tables[0], conditions)
+        if record_batches is None:
+            record_batches = scan_table(query_tables[0], conditions=conditions)
+        else:
+            # the records already satisfy the conditions
+            conditions = []
+    else:
+        [record_batches, modified_column_names] = select_records(query_tables, \
+            conditions, plan["table_conditions"], plan["query_columns"])
+    if modified_column_names != plan["column_names"]:
+        return False
+    code = plan.get("code")
+    if code is None or conditions != plan["conditions"]:
+        code = compile_query_code(modified_column_names, conditions, \
+            plan["output_columns"], plan["distinct"])
+
+    namespace = {"cell_value": cell_value}
+    namespace.update(plan.get("parameters") or {})
+    exec code in namespace
+    modified_column_names_dict = {}
+    for i, column_name in enumerate(modified_column_names):
+        modified_column_names_dict[column_name] = i
+    state = {"process_records": namespace["process_records"], \
+        "condition_tree": parse_condition_tree(conditions) if conditions else None}
+    output_records = set()
+
+    def process_records(records):
+        """
+            Returns the output lines of records, compiling the code again when the
+            AND/OR conditions are reordered on a sample of records
+        """
+        condition_tree = state["condition_tree"]
+        if isinstance(condition_tree, tuple) and PREDICATE_SAMPLE_SIZE and records:
+            reordered_tree = reorder_condition_tree(condition_tree, \
+                records[:PREDICATE_SAMPLE_SIZE], modified_column_names_dict)
+            if reordered_tree != condition_tree:
+                state["condition_tree"] = reordered_tree
+                namespace = {"cell_value": cell_value}
+                exec compile_query_code(modified_column_names, \
+                    flatten_condition_tree(reordered_tree), plan["output_columns"], \
+                    plan["distinct"]) in namespace
+                state["process_records"] = namespace["process_records"]
+        return state["process_records"](records, output_records)
+
+    # Process the first batch before printing anything so that a failing
+    # query prints only its error
+    record_batches = iter(record_batches)
+    lines = process_records(next(record_batches, []))
+
+    header = [column_name for column_name in modified_column_names \
+        if column_name in plan["output_columns"]]
+    if header:
+        print ",".join(header)
+    for records in record_batches:
+        for line in lines:
+            print line
+        lines = process_records(records)
+    for line in lines:
+        print line
+    return True
+
+class OutputRecorder(object):
+    """
+        File object writing to stream and remembering whether anything was written
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = False
+
+    def write(self, data):
+        self.written = True
+        self.stream.write(data)
+
+@contextmanager
+def recording_output():
+    """
+        Replace sys.stdout with an OutputRecorder of it within the block
+    """
+    recorder = OutputRecorder(sys.stdout)
+    sys.stdout = recorder
+    try:
+        yield recorder
+    finally:
+        sys.stdout = recorder.stream
+
+def query_plan_key(sql_statement):
+    """
+        Returns the key of the plan of sql_statement in the plan cache and the
+        integer constants of sql_statement
+        The key is sql_statement with its whitespace collapsed and its constants
+        replaced by ?, so queries that differ only in them share a plan
+    """
+    constants = []
+    def placeholder(match):
+        if match.group(1):
+            return match.group(1)
+        constants.append(match.group(2))
+        return "?"
+    return QUERY_CONSTANT.sub(placeholder, " ".join(sql_statement.split())), constants
+
+def map_condition_constants(conditions, function):
+    """
+        Returns conditions with every constant they compare a column with mapped by
+        function, the constants of the LIST_OPERATORS one by one
+    """
+    mapped_conditions = []
+    for condition in conditions:
+        if isinstance(condition, list) and len(str(condition[2]).split(".")) == 1:
+            if str(condition[1]) in LIST_OPERATORS:
+                value = "[" + ",".join([function(value.strip()) \
+                    for value in str(condition[2])[1:-1].split(",")]) + "]"
             else:
-                output_records.append(output)
+                value = function(str(condition[2]).strip())
+            condition = [condition[0], condition[1], value]
+        mapped_conditions.append(condition)
+    return mapped_conditions
+
+def parameterize_query_plan(plan, constants):
+    """
+        Returns plan with the constants of its conditions replaced by the placeholders
+        ?<position in constants> and its code compiled for them
+        Returns None if a constant of the conditions is not in constants or is in
+        it more than once, or if one of constants is not in the conditions
+    """
+    positions = {}
+    for position, constant in enumerate(constants):
+        positions[constant] = None if constant in positions else position
+    used_positions = set()
+    def placeholder(constant):
+        if positions[constant] is None:
+            raise KeyError(constant)
+        used_positions.add(positions[constant])
+        return "?%d" % positions[constant]
+
+    try:
+        conditions = map_condition_constants(plan["conditions"], placeholder)
+        table_conditions = {}
+        for table_name, table_condition in plan["table_conditions"].items():
+            table_conditions[table_name] = map_condition_constants(table_condition, placeholder)
+    except KeyError:
+        return None
+    if len(used_positions) != len(constants):
+        return None
+    plan = dict(plan, conditions=conditions, table_conditions=table_conditions, \
+        constants=len(constants))
+    try:
+        plan["code"] = compile_query_code(plan["column_names"], conditions, \
+            plan["output_columns"], plan["distinct"])
+    except (KeyError, ValueError):
+        return None
+    return plan
+
+def bind_query_plan(plan, constants):
+    """
+        Returns the cached plan with its placeholders replaced by constants, which
+        are also passed to its code as plan["parameters"]
+    """
+    def constant(placeholder):
+        return constants[int(placeholder[1:])]
+
+    table_conditions = {}
+    for table_name, table_condition in plan["table_conditions"].items():
+        table_conditions[table_name] = map_condition_constants(table_condition, constant)
+    parameters = {}
+    for position, value in enumerate(constants):
+        parameters["parameter_%d" % position] = int(value)
+    return dict(plan, conditions=map_condition_constants(plan["conditions"], constant), \
+        table_conditions=table_conditions, parameters=parameters)
+
+def plan_schema(plan):
+    """
+        Returns [(table_name, columns of table_name)] of the tables of plan
+        Returns None if one of them doesn't exist any more
+    """
+    schema = []
+    for table_name in plan["tables"]:
+        columns = lookup_table(table_name)
+        if columns is None:
+            return None
+        schema.append((table_name, list(columns)))
+    return schema
+
+def read_query_plans():
+    """
+        Returns the cached plans {key: (schema, time, plan)}
+    """
+    try:
+        with open(QUERY_PLAN_FILE, "rb") as f:
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return {}
 
-    for record in output_records:
-        print record
+def cache_query_plan(sql_statement, plan):
+    """
+        Save plan in the plan cache, dropping the oldest plans when it is full
+        Plans that can't be parameterized with the constants of sql_statement
+        are not saved
+        Failing to write the cache is not an error
+    """
+    if not sql_statement or not QUERY_PLAN_CACHE_SIZE:
+        return
+    key, constants = query_plan_key(sql_statement)
+    plan = parameterize_query_plan(plan, constants)
+    if plan is None:
+        return
+    try:
+        query_plans = read_query_plans()
+        query_plans[key] = (plan_schema(plan), time.time(), plan)
+        if len(query_plans) > QUERY_PLAN_CACHE_SIZE:
+            oldest = sorted(query_plans, key=lambda key: query_plans[key][1])
+            for key in oldest[:len(query_plans) - QUERY_PLAN_CACHE_SIZE]:
+                del query_plans[key]
+        write_file_atomically(QUERY_PLAN_FILE, marshal.dumps(query_plans))
+    except (IOError, OSError, ValueError):
+        pass
+
+def execute_cached_query(sql_statement):
+    """
+        Execute sql_statement with its cached plan, skipping parsing and planning
+        Returns False if there is no plan for it made for the current columns of
+        its tables, it is then planned again
+    """
+    if not QUERY_PLAN_CACHE_SIZE:
+        return False
+    key, constants = query_plan_key(sql_statement)
+    cached = read_query_plans().get(key)
+    if cached is None or cached[0] is None or cached[0] != plan_schema(cached[2]) \
+        or cached[2].get("constants") != len(constants):
+        return False
+    debug("query plan cache hit")
+    try:
+        if not execute_query_plan(bind_query_plan(cached[2], constants)):
+            debug("query plan doesn't match the columns of its tables")
+            return False
+    except Exception as e:
+        print "Incorrect Query", e
+    return True
 
-def dml_execute(none_identifiers, wildcard_token, aggregate_keyword, keywords):
+def dml_execute(none_identifiers, wildcard_token, aggregate_keyword, keywords, \
+    sql_statement=None):
     """
         SELECT A, B from table1, table2
         None_Identifiers = [u'A, B', u'table1, table2']
@@ -706,7 +3845,7 @@ def dml_execute(none_identifiers, wildcard_token, aggregate_keyword, keywords):
         table_keyerrors = 0
         for i, table in enumerate(query_tables):
             table_keyerrors = 0
-            if query_tables[i] not in TABLE_NAMES_LIST:
+            if not table_exists(query_tables[i]):
                 table_keyerrors += 1
                 print "table " + query_tables[i] + " doesn't exist"
             else:
@@ -740,42 +3879,37 @@ def dml_execute(none_identifiers, wildcard_token, aggregate_keyword, keywords):
             print "Incorrect Query", e
         return 0
 
-    try:
-        [query_tables, query_columns, none_identifiers] = \
-            get_query_tables_and_columns(wildcard_token, none_identifiers)
-    except Exception as e:
-        print "Incorrect Query", e
-        return
+    # A query whose tables or columns print errors is not cached, a cached
+    # plan would skip them
+    with recording_output() as validation_output:
+        try:
+            [query_tables, query_columns, none_identifiers] = \
+                get_query_tables_and_columns(wildcard_token, none_identifiers)
+        except Exception as e:
+            print "Incorrect Query", e
+            return
+    if validation_output.written:
+        sql_statement = None
 
     if query_tables == -1 and query_columns == -1 and none_identifiers == -1:
         return
 
-    try:
-        [all_records, modified_column_names] = join_tables(query_tables)
-    except Exception as e:
-        print "Incorrect Query", e
-        return
-
     if len(none_identifiers) == 1:
         # No WHERE conditions
-        all_records_flags = [True] * len(all_records)
         # No Equi-Join
         query_columns_to_hide = []
         try:
-            project_output(query_columns, all_records, \
-                modified_column_names, "DISTINCT" in keywords, \
-                all_records_flags, query_columns_to_hide)
+            plan = plan_query(query_tables, query_columns, [], \
+                query_columns_to_hide, "DISTINCT" in keywords)
+            execute_query_plan(plan)
         except Exception as e:
             print "Incorrect Query", e
             return
+        cache_query_plan(sql_statement, plan)
         return 0
 
     # project with conditions
 
-    modified_column_names_dict = {}
-    for i, column_name in enumerate(modified_column_names):
-        modified_column_names_dict[column_name] = i
-
     conditional_statement = None_Identifiers[1]
     try:
         conditions = get_conditions(conditional_statement, query_tables)
@@ -795,14 +3929,33 @@ def dml_execute(none_identifiers, wildcard_token, aggregate_keyword, keywords):
         return
 
     try:
-        all_records_flags = set_record_flags(all_records, conditions, modified_column_names_dict)
-    except Exception as e:
-        print "Incorrect Query", e
-        return
+        plan = plan_query(query_tables, query_columns, conditions, \
+            query_columns_to_hide, "DISTINCT" in keywords)
+    except (KeyError, ValueError, AttributeError, IndexError):
+        # The conditions fail on the first record instead
+        plan = None
+
+    if plan is not None:
+        try:
+            execute_query_plan(plan)
+        except Exception as e:
+            print "Incorrect Query", e
+            return
+        cache_query_plan(sql_statement, plan)
+        return 0
 
     try:
-        project_output(query_columns, all_records, modified_column_names, \
-            "DISTINCT" in keywords, all_records_flags, query_columns_to_hide)
+        table_conditions, conditions = push_down_conditions(conditions, query_tables)
+        [record_batches, modified_column_names] = select_records(query_tables, \
+            conditions, table_conditions, query_columns)
+        modified_column_names_dict = {}
+        for i, column_name in enumerate(modified_column_names):
+            modified_column_names_dict[column_name] = i
+        if conditions:
+            record_batches = filter_records(record_batches, conditions, \
+                modified_column_names_dict)
+        project_output(query_columns, record_batches, modified_column_names, \
+            "DISTINCT" in keywords, query_columns_to_hide)
     except Exception as e:
         print "Incorrect Query", e
         return
@@ -815,11 +3968,13 @@ if __name__ == '__main__':
         print "Add any SQL statement as an argument"
     elif len(sys.argv) == 2:
         SQL_STMNTS = sys.argv[1]
-        PARSED_SQL_STMNTS = format_sql_statements(SQL_STMNTS)
 
-        for l, parsed_sql in enumerate(PARSED_SQL_STMNTS):
+        for l, sql_statement in enumerate(split_sql_statements(SQL_STMNTS)):
             if l > 0:
                 print ""
+            if execute_cached_query(sql_statement):
+                continue
+            parsed_sql = parse_sql_statement(sql_statement)
             if parsed_sql[-1] == ';':
                 parsed_sql = parsed_sql[-1:]
 
@@ -830,4 +3985,5 @@ if __name__ == '__main__':
                 ddl_execute(DDL_Keyword, None_Identifiers)
 
             elif DML_Keyword == "SELECT":
-                dml_execute(None_Identifiers, Wildcard_Token, Aggregate_Keyword, Keywords)
+                dml_execute(None_Identifiers, Wildcard_Token, Aggregate_Keyword, Keywords, \
+                    sql_statement)